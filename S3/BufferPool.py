@@ -0,0 +1,135 @@
+## Amazon S3 manager - memory budget for transfer buffers
+## Author: Michal Ludvig <michal@logix.cz>
+##         http://www.logix.cz/michal
+## License: GPL Version 2
+
+import threading
+from logging import debug, info, warning, error
+
+from Config import Config
+
+__all__ = []
+
+class BufferPool(object):
+    """
+    Memory shared by the buffers of all transfers running at a time,
+    at most Config.transfer_memory_limit bytes of it (0 = unlimited).
+
+    get() hands out bytearrays for Pipeline and put() takes them back
+    for the next transfer. reserve() and unreserve() account for data
+    held elsewhere, e.g. multipart upload parts. Both wait while the
+    budget is used up, unless told not to. A request larger than the
+    whole budget waits until nobody else holds anything, so it runs
+    alone rather than never. 'peak' is the most memory held at once.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+    ## Sizes are rounded up to a power of two from here on, so that
+    ## buffers of one transfer fit the next one
+    min_size = 64 * 1024
+
+    ## Creating a singleton, threads may ask for it at the same time
+    def __new__(self):
+        self._instance_lock.acquire()
+        try:
+            if self._instance is None:
+                self._instance = object.__new__(self)
+                self._instance._initialized = False
+        finally:
+            self._instance_lock.release()
+        return self._instance
+
+    def __init__(self):
+        self._instance_lock.acquire()
+        try:
+            if not self._initialized:
+                self._init()
+                self._initialized = True
+        finally:
+            self._instance_lock.release()
+
+    def _init(self):
+        self.limit = Config().transfer_memory_limit
+        ## 'used' is held by transfers, 'cached' by free buffers
+        self.used = 0
+        self.cached = 0
+        self.peak = 0
+        self.free = {}
+        self.cond = threading.Condition()
+
+    def _size_class(self, size):
+        size_class = self.min_size
+        while size_class < size:
+            size_class *= 2
+        return size_class
+
+    def _fits(self, size, held):
+        if not self.limit or self.used + self.cached + size <= self.limit:
+            return True
+        ## Free buffers are the first to go
+        for size_class in self.free.keys():
+            self.cached -= size_class * len(self.free[size_class])
+            del self.free[size_class]
+            if self.used + self.cached + size <= self.limit:
+                return True
+        ## Waiting won't help if nobody else holds anything
+        return self.used <= held
+
+    def _take(self, size, held, wait):
+        while not self._fits(size, held):
+            if not wait:
+                return False
+            self.cond.wait()
+        self.used += size
+        self.peak = max(self.peak, self.used + self.cached)
+        return True
+
+    def get(self, size, wait = True):
+        """
+        Returns a bytearray of at least 'size' bytes, or None if
+        'wait' is False and the budget is used up.
+        """
+        size_class = self._size_class(size)
+        self.cond.acquire()
+        try:
+            if self.free.get(size_class):
+                self.cached -= size_class
+                self.used += size_class
+                return self.free[size_class].pop()
+            if not self._take(size_class, 0, wait):
+                return None
+        finally:
+            self.cond.release()
+        return bytearray(size_class)
+
+    def put(self, data):
+        """
+        Return a buffer from get() for reuse.
+        """
+        self.cond.acquire()
+        self.used -= len(data)
+        self.cached += len(data)
+        self.free.setdefault(len(data), []).append(data)
+        self.cond.notifyAll()
+        self.cond.release()
+
+    def reserve(self, nbytes, held = 0, wait = True):
+        """
+        Account for 'nbytes' of data held outside the pool. 'held' is
+        what the caller has reserved already and won't give back while
+        waiting. Returns False if 'wait' is False and they don't fit.
+        """
+        self.cond.acquire()
+        try:
+            return self._take(nbytes, held, wait)
+        finally:
+            self.cond.release()
+
+    def unreserve(self, nbytes):
+        self.cond.acquire()
+        self.used -= nbytes
+        self.cond.notifyAll()
+        self.cond.release()
+__all__.append("BufferPool")
+
+# vim:et:ts=4:sts=4:ai
@@ -17,6 +17,7 @@ except ImportError:
 
 from Config import Config
 from Exceptions import *
+from Retry import RetryPolicy
 from Utils import getTreeFromXml, appendXmlTextNode, getDictFromTree, dateS3toPython, sign_string, getBucketFromHostname, getHostnameFromBucket
 from S3Uri import S3Uri, S3UriS3
 from FileLists import fetch_remote_list
@@ -300,8 +301,6 @@ class CloudFront(object):
         "GetInvalInfo" : { 'method' : "GET", 'resource' : "/%(dist_id)s/invalidation/%(request_id)s" },
     }
 
-    ## Maximum attempts of re-issuing failed requests
-    _max_retries = 5
     dist_list = None
 
     def __init__(self, config):
@@ -468,39 +467,44 @@ class CloudFront(object):
     ## Low-level methods for handling CloudFront requests
     ## --------------------------------------------------
 
-    def send_request(self, op_name, dist_id = None, request_id = None, body = None, headers = {}, retries = _max_retries):
+    def send_request(self, op_name, dist_id = None, request_id = None, body = None, headers = {}, retries = None):
         operation = self.operations[op_name]
+        headers = headers.copy()
         if body:
             headers['content-type'] = 'text/plain'
-        request = self.create_request(operation, dist_id, request_id, headers)
-        conn = self.get_connection()
-        debug("send_request(): %s %s" % (request['method'], request['resource']))
-        conn.request(request['method'], request['resource'], body, request['headers'])
-        http_response = conn.getresponse()
-        response = {}
-        response["status"] = http_response.status
-        response["reason"] = http_response.reason
-        response["headers"] = dict(http_response.getheaders())
-        response["data"] =  http_response.read()
-        conn.close()
-
-        debug("CloudFront: response: %r" % response)
-
-        if response["status"] >= 500:
-            e = CloudFrontError(response)
-            if retries:
-                warning(u"Retrying failed request: %s" % op_name)
-                warning(unicode(e))
-                warning("Waiting %d sec..." % self._fail_wait(retries))
-                time.sleep(self._fail_wait(retries))
-                return self.send_request(op_name, dist_id, body, retries - 1)
-            else:
-                raise e
+        retry = RetryPolicy().begin(op_name, retries)
+        while True:
+            ## Dated and signed anew for each attempt, retries after a
+            ## while would be refused as expired otherwise
+            request = self.create_request(operation, dist_id, request_id, headers.copy())
+            try:
+                conn = self.get_connection()
+                debug("send_request(): %s %s" % (request['method'], request['resource']))
+                conn.request(request['method'], request['resource'], body, request['headers'])
+                http_response = conn.getresponse()
+                response = {}
+                response["status"] = http_response.status
+                response["reason"] = http_response.reason
+                response["headers"] = dict(http_response.getheaders())
+                response["data"] =  http_response.read()
+                conn.close()
+            except ParameterError:
+                raise
+            except Exception, e:
+                if retry.again(e):
+                    continue
+                raise
 
-        if response["status"] < 200 or response["status"] > 299:
-            raise CloudFrontError(response)
+            debug("CloudFront: response: %r" % response)
 
-        return response
+            if response["status"] < 200 or response["status"] > 299:
+                e = CloudFrontError(response)
+                if retry.again(e):
+                    continue
+                raise e
+
+            retry.done()
+            return response
 
     def create_request(self, operation, dist_id = None, request_id = None, headers = None):
         resource = cloudfront_resource + (
@@ -538,10 +542,6 @@ class CloudFront(object):
             raise ParameterError("CloudFront commands don't work from behind a HTTP proxy")
         return httplib.HTTPSConnection(self.config.cloudfront_host)
 
-    def _fail_wait(self, retries):
-        # Wait a few seconds. The more it fails the more we wait.
-        return (self._max_retries - retries + 1) * 3
-
     def get_dist_name_for_bucket(self, uri):
         if (uri.type == "cf"):
             return uri
@@ -0,0 +1,244 @@
+## Amazon S3 manager - on-the-fly compression
+## Author: Michal Ludvig <michal@logix.cz>
+##         http://www.logix.cz/michal
+## License: GPL Version 2
+
+import os
+import zlib
+import Queue
+import threading
+from logging import debug, info, warning, error
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from Exceptions import ParameterError
+
+__all__ = []
+
+class GzipCodec(object):
+    name = "gzip"
+    content_encoding = "gzip"
+    default_level = 6
+
+    def __init__(self, level = -1):
+        if level < 0:
+            level = self.default_level
+        self.level = level
+
+    def compress(self, data):
+        """
+        Compress 'data' into a complete gzip member. A sequence
+        of members is a valid gzip stream again (RFC 1952).
+        """
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompressobj(self):
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+class ZstdCodec(object):
+    name = "zstd"
+    content_encoding = "zstd"
+    default_level = 3
+
+    def __init__(self, level = -1):
+        if not zstandard:
+            raise ParameterError("Compression with zstd needs the python-zstandard module")
+        if level < 0:
+            level = self.default_level
+        self.level = level
+
+    def compress(self, data):
+        """
+        Compress 'data' into a complete zstd frame. Concatenated
+        frames are a valid zstd stream again.
+        """
+        return zstandard.ZstdCompressor(level = self.level).compress(data)
+
+    def decompressobj(self):
+        return ZstdDecompressObj()
+
+class ZstdDecompressObj(object):
+    """
+    zstd counterpart of zlib.decompressobj() that goes on over any
+    number of concatenated frames, wherever they end. The one of
+    python-zstandard stops at the end of the first frame and, before
+    version 0.16, drops whatever follows it. A stream_writer() keeps
+    decoding frame after frame.
+    """
+    def __init__(self):
+        self.output = []
+        self.writer = zstandard.ZstdDecompressor().stream_writer(self)
+
+    def decompress(self, data):
+        self.writer.write(data)
+        data = "".join(self.output)
+        self.output = []
+        return data
+
+    ## Called by the stream_writer() with the decompressed data
+    def write(self, data):
+        self.output.append(data)
+        return len(data)
+
+codecs = {
+    "gzip" : GzipCodec,
+    "zstd" : ZstdCodec,
+}
+__all__.append("codecs")
+
+def get_codec(name, level = -1):
+    try:
+        return codecs[name](level)
+    except KeyError:
+        raise ParameterError("Unknown compression '%s', use one of: %s" % (name, ", ".join(codecs.keys())))
+__all__.append("get_codec")
+
+def cpu_count():
+    try:
+        return max(1, os.sysconf("SC_NPROCESSORS_ONLN"))
+    except (AttributeError, ValueError, OSError):
+        return 1
+__all__.append("cpu_count")
+
+class ParallelCompressor(object):
+    """
+    ParallelCompressor(codec, block_size, threads)
+
+    Compresses a file in blocks of 'block_size' bytes, each into an
+    independent gzip member or zstd frame, on up to 'threads' threads.
+    Both zlib and zstd release the GIL while compressing, so the work
+    really spreads over all cores. At most two blocks per thread are
+    read ahead, which bounds the memory used.
+    """
+    def __init__(self, codec, block_size, threads):
+        self.codec = codec
+        self.block_size = block_size
+        self.threads = max(1, threads)
+
+    def compress(self, file):
+        """
+        Yields compressed blocks of 'file' in order. Updates
+        self.md5_hash and self.size with the uncompressed data.
+        """
+        self.md5_hash = md5()
+        self.size = 0
+        if self.threads == 1:
+            while True:
+                data = file.read(self.block_size)
+                if not data:
+                    return
+                self.md5_hash.update(data)
+                self.size += len(data)
+                yield self.codec.compress(data)
+
+        tasks = Queue.Queue()
+        results = {}
+        cond = threading.Condition()
+
+        def worker():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                seq, data = task
+                try:
+                    result = self.codec.compress(data)
+                except Exception, e:
+                    result = e
+                cond.acquire()
+                results[seq] = result
+                cond.notify()
+                cond.release()
+
+        for i in range(self.threads):
+            t = threading.Thread(target = worker)
+            t.setDaemon(True)
+            t.start()
+
+        next_read = 0
+        next_out = 0
+        eof = False
+        failure = None
+        while True:
+            while not eof and next_read - next_out < 2 * self.threads:
+                data = file.read(self.block_size)
+                if not data:
+                    eof = True
+                    break
+                self.md5_hash.update(data)
+                self.size += len(data)
+                tasks.put((next_read, data))
+                next_read += 1
+            if next_out == next_read:
+                break
+            cond.acquire()
+            while not results.has_key(next_out):
+                cond.wait()
+            result = results.pop(next_out)
+            cond.release()
+            if isinstance(result, Exception):
+                failure = result
+                break
+            yield result
+            next_out += 1
+
+        for i in range(self.threads):
+            tasks.put(None)
+        if failure:
+            raise failure
+__all__.append("ParallelCompressor")
+
+class DecompressingStream(object):
+    """
+    DecompressingStream(stream, codec)
+
+    File-like wrapper that decompresses everything written through it
+    into 'stream'. Handles any number of concatenated gzip members or
+    zstd frames. Keeps the MD5 and size of the decompressed data.
+    """
+    def __init__(self, stream, codec):
+        self.stream = stream
+        self.codec = codec
+        self.decompressor = None
+        self.md5_hash = md5()
+        self.raw_md5_hash = md5()
+        self.size = 0
+
+    def write(self, data):
+        data = str(data)
+        self.raw_md5_hash.update(data)
+        while data:
+            if self.decompressor is None:
+                self.decompressor = self.codec.decompressobj()
+            self._output(self.decompressor.decompress(data))
+            ## Whatever follows the end of a member starts the next one
+            data = getattr(self.decompressor, "unused_data", "")
+            if data or getattr(self.decompressor, "eof", False):
+                self.decompressor = None
+
+    def _output(self, data):
+        if data:
+            self.md5_hash.update(data)
+            self.size += len(data)
+            self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def finish(self):
+        self.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+__all__.append("DecompressingStream")
+
+# vim:et:ts=4:sts=4:ai
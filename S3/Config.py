@@ -24,7 +24,35 @@ class Config(object):
     progress_meter = True
     progress_class = Progress.ProgressCR
     send_chunk = 4096
+    # Upload from regular files with sendfile() over plain HTTP
+    use_sendfile = True
+    sendfile_chunk = 1024 * 1024
     recv_chunk = 4096
+    # Buffers used by the read/hash/write pipeline, send_chunk
+    # and recv_chunk are the smallest chunks it will move
+    transfer_buffers = 4
+    transfer_buffer_size = 2 * 1024 * 1024
+    # Memory all transfer buffers, multipart upload parts and fan-out
+    # read-ahead may take together, 0 = unlimited
+    transfer_memory_limit = 0
+    # Aggregate bandwidth limits in bytes/sec for all transfers, 0 = unlimited
+    limit_rate_up = 0
+    limit_rate_down = 0
+    # Limits in this file override the above at runtime (re-read on change or SIGUSR1)
+    limit_rate_file = ""
+    # [put, get, sync] Keep bulk transfers from evicting the page cache: read
+    # ahead sequentially and drop transferred data from the cache as we go.
+    # direct_io reads local files with O_DIRECT instead, where supported.
+    cache_neutral = False
+    direct_io = False
+    # [sync] Upload files in "key" order or read them in "inode" or physical
+    # "extent" order, with up to prefetch_size bytes of the next ones read ahead
+    io_order = "key"
+    prefetch_size = 64 * 1024 * 1024
+    # Abort and retry requests slower than low_speed_limit bytes/sec
+    # for low_speed_time seconds, 0 = never
+    low_speed_limit = 0
+    low_speed_time = 30
     list_md5 = False
     human_readable_sizes = False
     extra_headers = SortedDict(ignore_case = True)
@@ -39,6 +67,10 @@ class Config(object):
     proxy_host = ""
     proxy_port = 3128
     encrypt = False
+    # Encrypt the next files on this many gpg processes (0 = one per CPU)
+    # while uploading, with at most encrypt_buffer_size bytes waiting
+    encrypt_workers = 0
+    encrypt_buffer_size = 64 * 1024 * 1024
     dry_run = False
     preserve_attrs = True
     preserve_attrs_list = [
@@ -65,6 +97,30 @@ class Config(object):
     mime_type = ""
     # List of checks to be performed for 'sync'
     sync_checks = ['size', 'md5']   # 'weak-timestamp'
+    # [sync] Copy files that are already stored under another name instead of uploading them
+    detect_renames = True
+    # [sync] Make objects whose content is in some local file already by a local
+    # "copy" (a reflink where the filesystem can) or a "hardlink" instead of
+    # downloading them, "off" = always download
+    local_reuse = "copy"
+    # Keep MD5 sums of local files in this file between runs
+    cache_file = ""
+    # [sync] Upload only the appended data of files that have grown, copying the
+    # rest from the old object with UploadPartCopy
+    append_uploads = False
+    # [put, sync] Upload identical files only once, copy the rest on the server side
+    dedup_uploads = True
+    # [put, sync, get] Pack files smaller than pack_threshold into archives
+    # of about pack_archive_size bytes, with an index for ranged reads
+    pack_small_files = False
+    pack_threshold = 64 * 1024
+    pack_archive_size = 64 * 1024 * 1024
+    # [put, sync] Compress uploads on the fly with "gzip" or "zstd" ("" = don't),
+    # on compress_threads threads (0 = one per CPU), level -1 = codec default
+    compress = ""
+    compress_level = -1
+    compress_threads = 0
+    compress_block_size = 1024 * 1024
     # List of compiled REGEXPs
     exclude = []
     include = []
@@ -77,16 +133,41 @@ class Config(object):
     reduced_redundancy = False
     follow_symlinks = False
     socket_timeout = 300
+    # Retry failed requests with exponential backoff (seconds) and full jitter
+    max_retries = 5
+    retry_delay = 3
+    retry_max_delay = 60
+    # Number of retries shared by all requests of one command
+    retry_budget = 100
     invalidate_on_cf = False
     website_index = "index.html"
     website_error = ""
     website_endpoint = "http://%(bucket)s.s3-website-%(location)s.amazonaws.com/"
-    parallel_multipart_download = False
-    parallel_multipart_upload = False
+    # [get, sync] Download objects from this size up in parallel ranges
+    # of at least parallel_multipart_download_part_size, more for large ones
+    parallel_multipart_download = True
+    parallel_multipart_download_threshold = 64 * 1024 * 1024
+    parallel_multipart_download_part_size = 8 * 1024 * 1024
     parallel_multipart_download_threads = 5
-    parallel_multipart_upload_threads = 5 
-    parallel_multipart_download_count = 5 
-    parallel_multipart_upload_count = 5 
+    # Upload files from this size up in parts of at least multipart_upload_part_size,
+    # more for files over 10000 parts, on multipart_upload_threads threads. Compressed,
+    # encrypted and stdin uploads use the same parts and threads.
+    multipart_upload = True
+    multipart_upload_threshold = 64 * 1024 * 1024
+    multipart_upload_part_size = 16 * 1024 * 1024
+    multipart_upload_threads = 5
+    # [put, sync] Uploads of one file to several destinations read it only once,
+    # keeping up to fanout_buffer_size bytes (per part) for those falling behind
+    fanout_buffer_size = 8 * 1024 * 1024
+    # Request a slow part again once it takes longer than 95% of the finished parts
+    parallel_multipart_download_hedge = True
+    # Copy objects from this size up with parallel UploadPartCopy requests
+    multipart_copy_threshold = 1024 * 1024 * 1024
+    multipart_copy_part_size = 256 * 1024 * 1024
+    multipart_copy_threads = 5
+    # [cp, mv, sync] Read the source objects with the credentials and endpoint
+    # of this config file, relaying their data to the destination through s3cmd
+    source_config = ""
 
     ## Creating a singleton
     def __new__(self, configfile = None):
@@ -121,6 +202,9 @@ class Config(object):
     def dump_config(self, stream):
         ConfigDumper(stream).dump("default", self)
 
+    def _set(self, option, value):
+        setattr(Config, option, value)
+
     def update_option(self, option, value):
         if value is None:
             return
@@ -131,24 +215,44 @@ class Config(object):
         ## verbosity must be known to "logging" module
         if option == "verbosity":
             try:
-                setattr(Config, "verbosity", logging._levelNames[value])
+                self._set("verbosity", logging._levelNames[value])
             except KeyError:
                 error("Config: verbosity level '%s' is not valid" % value)
         ## allow yes/no, true/false, on/off and 1/0 for boolean options
         elif type(getattr(Config, option)) is type(True):   # bool
             if str(value).lower() in ("true", "yes", "on", "1"):
-                setattr(Config, option, True)
+                self._set(option, True)
             elif str(value).lower() in ("false", "no", "off", "0"):
-                setattr(Config, option, False)
+                self._set(option, False)
             else:
                 error("Config: value of option '%s' must be Yes or No, not '%s'" % (option, value))
         elif type(getattr(Config, option)) is type(42):     # int
             try:
-                setattr(Config, option, int(value))
+                self._set(option, int(value))
             except ValueError, e:
                 error("Config: value of option '%s' must be an integer, not '%s'" % (option, value))
         else:                           # string
-            setattr(Config, option, value)
+            self._set(option, value)
+
+class ProfileConfig(Config):
+    """
+    ProfileConfig(configfile)
+
+    Settings from 'configfile' on top of those of Config(), without
+    changing the latter. Lets one run talk to a second account or
+    S3-compatible service, e.g. the source side of a relay copy.
+    Not a singleton, pass it to S3() wherever it's needed.
+    """
+    def __new__(self, configfile):
+        return object.__new__(self)
+
+    def __init__(self, configfile):
+        cp = ConfigParser(configfile)
+        for option in self.option_list():
+            self.update_option(option, cp.get(option))
+
+    def _set(self, option, value):
+        setattr(self, option, value)
 
 class ConfigParser(object):
     def __init__(self, file, sections = []):
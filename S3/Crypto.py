@@ -0,0 +1,338 @@
+## Amazon S3 manager - streaming GPG encryption
+## Author: Michal Ludvig <michal@logix.cz>
+##         http://www.logix.cz/michal
+## License: GPL Version 2
+
+import os
+import time
+import errno
+import fcntl
+import signal
+import tempfile
+import subprocess
+import threading
+from logging import debug, info, warning, error
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from Config import Config
+from Exceptions import InvalidFileError, S3DecodeError
+from Utils import unicodise
+
+__all__ = []
+
+def gpg_start(template, input_file, output_file, stdout = None):
+    """
+    Start gpg as described by 'template' (Config.gpg_encrypt or
+    Config.gpg_decrypt). The passphrase goes in on gpg's stdin, so
+    'input_file' must be a file or a named pipe, see GpgDecryptStream.
+    No other descriptors are inherited, pipes of other gpg processes
+    would never see EOF otherwise. Messages from gpg are logged by a
+    background thread.
+    """
+    cfg = Config()
+    args = {
+        "gpg_command" : cfg.gpg_command,
+        "passphrase_fd" : "0",
+        "input_file" : input_file,
+        "output_file" : output_file,
+    }
+    command = [item % args for item in template.split(" ")]
+    debug("GPG command: " + " ".join(command))
+
+    process = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = stdout, stderr = subprocess.PIPE,
+                               close_fds = True)
+    try:
+        process.stdin.write(cfg.gpg_passphrase + "\n")
+        process.stdin.close()
+    except IOError, e:
+        ## gpg is gone already, its exit code will tell
+        debug("GPG: can't pass the passphrase: %s" % e)
+
+    def log_messages():
+        for line in process.stderr:
+            debug("GPG: " + line.rstrip())
+    logger = threading.Thread(target = log_messages)
+    logger.setDaemon(True)
+    logger.start()
+    return process
+__all__.append("gpg_start")
+
+class GpgEncryptor(object):
+    """
+    GpgEncryptor(filename)
+
+    Encrypts 'filename' with Config.gpg_encrypt, chunks() yields the
+    encrypted data as gpg writes them to its stdout. Nothing is
+    stored on disk.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def chunks(self):
+        info(u"Encrypting file %s..." % unicodise(self.filename))
+        process = gpg_start(Config().gpg_encrypt, self.filename, "-", stdout = subprocess.PIPE)
+        while True:
+            data = process.stdout.read(self.chunk_size)
+            if not data:
+                break
+            yield data
+        exitcode = process.wait()
+        if exitcode != 0:
+            raise InvalidFileError(u"%s: gpg failed with exit code %d" % (unicodise(self.filename), exitcode))
+__all__.append("GpgEncryptor")
+
+class GpgDecryptStream(object):
+    """
+    GpgDecryptStream(stream)
+
+    File-like wrapper that pipes everything written through it into
+    gpg and the decrypted output into 'stream'. Keeps the MD5 of both
+    the encrypted and the decrypted data. finish() must be called
+    after the last write.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.md5_hash = md5()
+        self.raw_md5_hash = md5()
+        self.size = 0
+        self.failure = None
+        ## The data go in through a named pipe, stdin is taken by the
+        ## passphrase. It's gone from the disk once both ends are open.
+        tmpdir = tempfile.mkdtemp(prefix = "s3cmd-")
+        fifo = os.path.join(tmpdir, "data")
+        try:
+            os.mkfifo(fifo, 0600)
+            self.process = gpg_start(Config().gpg_decrypt, fifo, "-", stdout = subprocess.PIPE)
+            self.reader = threading.Thread(target = self._reader)
+            self.reader.setDaemon(True)
+            self.reader.start()
+            self.input = self._open_fifo(fifo)
+        finally:
+            if os.path.exists(fifo):
+                os.unlink(fifo)
+            os.rmdir(tmpdir)
+
+    def _open_fifo(self, fifo):
+        ## A blocking open would wait forever if gpg fails before it
+        ## opens the pipe
+        while True:
+            try:
+                fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError, e:
+                if e.errno != errno.ENXIO:
+                    raise
+            if self.process.poll() is not None:
+                self.reader.join()
+                raise S3DecodeError("gpg exited with code %d" % self.process.returncode)
+            time.sleep(0.01)
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return os.fdopen(fd, "wb")
+
+    def _reader(self):
+        try:
+            while True:
+                data = os.read(self.process.stdout.fileno(), 1024 * 1024)
+                if not data:
+                    break
+                self.md5_hash.update(data)
+                self.size += len(data)
+                self.stream.write(data)
+        except Exception, e:
+            self.failure = e
+
+    def write(self, data):
+        self.raw_md5_hash.update(data)
+        try:
+            self.input.write(data)
+        except (IOError, OSError), e:
+            ## gpg gave up early, e.g. on a wrong passphrase or bad
+            ## data, downloading the object again won't help
+            try:
+                self.input.close()
+            except (IOError, OSError):
+                pass
+            self.reader.join()
+            exitcode = self.process.wait()
+            raise S3DecodeError("gpg exited with code %d (%s)" % (exitcode, e))
+
+    def flush(self):
+        self.input.flush()
+
+    def finish(self):
+        self.input.close()
+        self.reader.join()
+        exitcode = self.process.wait()
+        self.stream.flush()
+        if self.failure:
+            raise self.failure
+        if exitcode != 0:
+            raise IOError("gpg exited with code %d" % exitcode)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+__all__.append("GpgDecryptStream")
+
+class EncryptionJob(object):
+    def __init__(self, pool, filename):
+        self.pool = pool
+        self.filename = filename
+        self.data = []
+        self.pending = 0
+        self.done = False
+        self.cancelled = False
+        self.failure = None
+
+    def chunks(self):
+        """
+        Yields the encrypted data of the file as the pool workers
+        produce them, like GpgEncryptor.chunks() does.
+        """
+        cond = self.pool.cond
+        while True:
+            cond.acquire()
+            while not self.data and not self.done:
+                cond.wait()
+            data = None
+            if self.data:
+                data = self.data.pop(0)
+                self.pending -= len(data)
+                self.pool.used -= len(data)
+                cond.notifyAll()
+            cond.release()
+            if data is None:
+                break
+            yield data
+        if self.failure:
+            raise self.failure
+
+class EncryptionPool(object):
+    """
+    EncryptionPool(filenames, workers, buffer_size)
+
+    Encrypts 'filenames' in this order on up to 'workers' gpg processes
+    running ahead of the uploads, so that encrypting the next files
+    overlaps with sending the current one. The encrypted data wait in
+    memory until encryptor() hands them out. Workers stop once
+    'buffer_size' bytes are waiting, only the file being uploaded may
+    always add one more chunk so that it never waits for the others.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, filenames, workers, buffer_size):
+        self.jobs = [EncryptionJob(self, filename) for filename in filenames]
+        self.buffer_size = buffer_size
+        self.used = 0
+        self.head = 0
+        self.next_job = 0
+        self.current = None
+        self.cond = threading.Condition()
+        for i in range(min(max(1, workers), len(self.jobs))):
+            t = threading.Thread(target = self._worker)
+            t.setDaemon(True)
+            t.start()
+
+    def _worker(self):
+        while True:
+            self.cond.acquire()
+            if self.next_job >= len(self.jobs):
+                self.cond.release()
+                return
+            job = self.jobs[self.next_job]
+            self.next_job += 1
+            self.cond.release()
+            try:
+                if not job.cancelled:
+                    self._encrypt(job)
+            except Exception, e:
+                job.failure = e
+            self.cond.acquire()
+            job.done = True
+            self.cond.notifyAll()
+            self.cond.release()
+
+    def _encrypt(self, job):
+        debug(u"Encrypting file %s..." % unicodise(job.filename))
+        process = gpg_start(Config().gpg_encrypt, job.filename, "-", stdout = subprocess.PIPE)
+        while True:
+            data = process.stdout.read(self.chunk_size)
+            if not data:
+                break
+            self.cond.acquire()
+            while not job.cancelled and not self._has_room(job, len(data)):
+                self.cond.wait()
+            if job.cancelled:
+                self.cond.release()
+                os.kill(process.pid, signal.SIGTERM)
+                break
+            job.data.append(data)
+            job.pending += len(data)
+            self.used += len(data)
+            self.cond.notifyAll()
+            self.cond.release()
+        process.stdout.close()
+        exitcode = process.wait()
+        if exitcode != 0 and not job.cancelled:
+            job.failure = InvalidFileError(u"%s: gpg failed with exit code %d" % (unicodise(job.filename), exitcode))
+
+    def _has_room(self, job, size):
+        if self.used + size <= self.buffer_size:
+            return True
+        return job is self.current and job.pending == 0
+
+    def _cancel(self, job):
+        job.cancelled = True
+        self.used -= job.pending
+        job.data = []
+        job.pending = 0
+        self.cond.notifyAll()
+
+    def encryptor(self, filename):
+        """
+        Returns the source of encrypted data for 'filename', to be
+        passed to S3.object_put_encrypted(). Files must be asked for
+        in the order given to the pool, those skipped over are not
+        encrypted any further. Files the pool doesn't know get a
+        GpgEncryptor of their own.
+        """
+        self.cond.acquire()
+        try:
+            if self.current:
+                self._cancel(self.current)
+                self.current = None
+            head = self.head
+            while head < len(self.jobs) and self.jobs[head].filename != filename:
+                head += 1
+            if head == len(self.jobs):
+                return GpgEncryptor(filename)
+            while self.head < head:
+                self._cancel(self.jobs[self.head])
+                self.head += 1
+            self.current = self.jobs[self.head]
+            self.head += 1
+            self.cond.notifyAll()
+            return self.current
+        finally:
+            self.cond.release()
+
+    def close(self):
+        """
+        Stop encrypting files that won't be asked for anymore.
+        """
+        self.cond.acquire()
+        if self.current:
+            self._cancel(self.current)
+            self.current = None
+        while self.head < len(self.jobs):
+            self._cancel(self.jobs[self.head])
+            self.head += 1
+        self.cond.release()
+__all__.append("EncryptionPool")
+
+# vim:et:ts=4:sts=4:ai
@@ -0,0 +1,115 @@
+## Amazon S3 manager - resumable download state
+## Author: Michal Ludvig <michal@logix.cz>
+##         http://www.logix.cz/michal
+## License: GPL Version 2
+
+import os
+import threading
+from logging import debug, info, warning, error
+
+class DownloadState(object):
+    """
+    Sidecar file recording which byte ranges of a parallel
+    download have already been written to the destination file.
+
+    The state is only valid for the object it was created for,
+    identified by its ETag and size. Ranges are inclusive
+    (start, end) tuples as used in HTTP Range headers.
+    """
+    suffix = ".s3cmd-parts"
+
+    def __init__(self, filename, etag = "", size = 0):
+        self.filename = filename + self.suffix
+        self.etag = etag.strip('"\'')
+        self.size = size
+        self.done = []
+        self.lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def load(self):
+        """
+        Read the sidecar file. Returns True if it exists and
+        belongs to the same object, False otherwise.
+        """
+        self.done = []
+        try:
+            f = open(self.filename, "r")
+        except IOError:
+            return False
+        etag, size, done = "", -1, []
+        for line in f:
+            try:
+                key, val = line.strip().split(":", 1)
+                if key == "etag":
+                    etag = val.strip()
+                elif key == "size":
+                    size = long(val)
+                elif key == "range":
+                    start, end = val.strip().split("-")
+                    done.append((long(start), long(end)))
+            except ValueError:
+                warning(u"Ignoring invalid line in '%s': %s" % (self.filename, line.strip()))
+        f.close()
+        if etag != self.etag or size != self.size:
+            debug(u"Download state %s is for a different object" % self.filename)
+            return False
+        self.done = self._merge(done)
+        return True
+
+    def save(self):
+        tmp_filename = self.filename + ".tmp"
+        f = open(tmp_filename, "w")
+        f.write("etag: %s\n" % self.etag)
+        f.write("size: %d\n" % self.size)
+        for start, end in self.done:
+            f.write("range: %d-%d\n" % (start, end))
+        f.close()
+        os.rename(tmp_filename, self.filename)
+
+    def remove(self):
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+    def add(self, start, end):
+        """
+        Record range start..end as complete and
+        write the updated state to disk.
+        """
+        self.lock.acquire()
+        try:
+            self.done = self._merge(self.done + [(start, end)])
+            self.save()
+        finally:
+            self.lock.release()
+
+    def completed(self):
+        return sum([end - start + 1 for start, end in self.done])
+
+    def missing(self):
+        """
+        Returns a list of (start, end) ranges not yet downloaded.
+        """
+        missing = []
+        position = 0
+        for start, end in self.done:
+            if start > position:
+                missing.append((position, start - 1))
+            position = max(position, end + 1)
+        if position < self.size:
+            missing.append((position, self.size - 1))
+        return missing
+
+    def _merge(self, ranges):
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+# vim:et:ts=4:sts=4:ai
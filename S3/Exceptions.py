@@ -44,7 +44,7 @@ class S3Error (S3Exception):
         if response.has_key("headers"):
             for header in response["headers"]:
                 debug("HttpHeader: %s: %s" % (header, response["headers"][header]))
-        if response.has_key("data"):
+        if response.has_key("data") and response["data"]:
             tree = getTreeFromXml(response["data"])
             error_node = tree
             if not error_node.tag == "Error":
@@ -76,9 +76,18 @@ class S3DownloadError(S3Exception):
 class S3RequestError(S3Exception):
     pass
 
+class S3TransferTooSlow(S3Exception):
+    pass
+
+class S3TransferCancelled(S3Exception):
+    pass
+
 class S3ResponseError(S3Exception):
     pass
 
+class S3DecodeError(S3Exception):
+    pass
+
 class InvalidFileError(S3Exception):
     pass
 
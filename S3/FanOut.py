@@ -0,0 +1,203 @@
+## Amazon S3 manager - one read for several uploads
+## Author: Michal Ludvig <michal@logix.cz>
+##         http://www.logix.cz/michal
+## License: GPL Version 2
+
+import threading
+from logging import debug, info, warning, error
+
+from Utils import unicodise, open_bulk
+from BufferPool import BufferPool
+
+__all__ = []
+
+class SharedFile(object):
+    """
+    SharedFile(filename, offset, length, window)
+
+    Reads 'length' bytes of 'filename' from 'offset' on just once for
+    several uploads of them running at the same time, each through a
+    view() of its own. Whichever view is ahead reads the next chunk
+    from disk, the others find it in memory. A chunk is dropped once
+    all views are past it.
+
+    A view that falls more than 'window' bytes behind the fastest one,
+    or seeks back to retry, is detached and reads the file on its own
+    from then on. A slow or failing upload therefore never holds up
+    the others nor makes them keep more than 'window' bytes around.
+    Chunks count against the BufferPool budget. A view that finds no
+    room there for the next chunk doesn't wait, it detaches as well.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, filename, offset, length, window):
+        self.filename = filename
+        self.stop = offset + length
+        self.window = max(window, self.chunk_size)
+        self.file = open_bulk(filename)
+        self.file.seek(offset)
+        self.chunks = []
+        self.base = offset
+        self.end = offset
+        self.eof = False
+        self.reading = False
+        self.views = []
+        self.cond = threading.Condition()
+
+    def view(self):
+        """
+        Return a new file-like view starting at 'offset', to be
+        passed to S3.send_file() and closed when done.
+        """
+        view = SharedFileView(self, self.base)
+        self.cond.acquire()
+        self.views.append(view)
+        self.cond.release()
+        return view
+
+    def read(self, view, size):
+        """
+        Return up to 'size' bytes at the position of 'view', or None
+        if 'view' had to be detached.
+        """
+        self.cond.acquire()
+        try:
+            while view in self.views:
+                if view.position < self.base:
+                    self._detach(view)
+                    break
+                if view.position < self.end:
+                    return self._get(view.position, size)
+                if self.eof or self.end >= self.stop:
+                    return ""
+                if self.reading:
+                    self.cond.wait()
+                else:
+                    self._read_chunk(view)
+            return None
+        finally:
+            self.cond.release()
+
+    def _read_chunk(self, view):
+        ## Make room first, the slowest views would hold it all
+        while self.end + self.chunk_size - self.base > self.window:
+            slowest = None
+            for other in self.views:
+                if other is not view and (not slowest or other.position < slowest.position):
+                    slowest = other
+            if not slowest or slowest.position >= self.end:
+                break
+            self._detach(slowest)
+        size = min(self.chunk_size, self.stop - self.end)
+        if not BufferPool().reserve(size, wait = False):
+            self._detach(view)
+            return
+        self.reading = True
+        self.cond.release()
+        data = ""
+        try:
+            data = self.file.read(size)
+        finally:
+            self.cond.acquire()
+            self.reading = False
+            self.cond.notifyAll()
+            BufferPool().unreserve(size - len(data))
+        if not data:
+            self.eof = True
+            return
+        self.chunks.append(data)
+        self.end += len(data)
+
+    def _get(self, position, size):
+        offset = position - self.base
+        for data in self.chunks:
+            if offset < len(data):
+                return data[offset:offset + size]
+            offset -= len(data)
+        return ""
+
+    def _detach(self, view):
+        debug(u"%s: upload from %d reads the file on its own" % (unicodise(self.filename), view.position))
+        self.views.remove(view)
+        view.detached = True
+        self._trim()
+
+    def _trim(self):
+        if self.views:
+            low = min([view.position for view in self.views])
+        else:
+            low = self.end
+        while self.chunks and self.base + len(self.chunks[0]) <= low:
+            data = self.chunks.pop(0)
+            self.base += len(data)
+            BufferPool().unreserve(len(data))
+        self.cond.notifyAll()
+
+    def advance(self, view):
+        self.cond.acquire()
+        if view in self.views:
+            self._trim()
+        self.cond.release()
+
+    def close_view(self, view):
+        self.cond.acquire()
+        try:
+            if view in self.views:
+                self.views.remove(view)
+                self._trim()
+            if self.file and not self.views:
+                self.file.close()
+                self.file = None
+        finally:
+            self.cond.release()
+__all__.append("SharedFile")
+
+class SharedFileView(object):
+    """
+    One reader of a SharedFile, file-like enough for S3.send_file().
+    Used by one thread only.
+    """
+    def __init__(self, shared, position):
+        self.shared = shared
+        self.name = shared.filename
+        self.position = position
+        self.detached = False
+        self.file = None
+
+    def seek(self, offset):
+        self.position = offset
+        if self.file:
+            self.file.seek(offset)
+
+    def tell(self):
+        return self.position
+
+    def read(self, size = -1):
+        if size < 0:
+            size = self.shared.stop - self.position
+        data = None
+        if not self.detached:
+            data = self.shared.read(self, size)
+        if data is None:
+            if not self.file:
+                self.file = open_bulk(self.shared.filename)
+                self.file.seek(self.position)
+            data = self.file.read(max(0, min(size, self.shared.stop - self.position)))
+        self.position += len(data)
+        if not self.detached:
+            self.shared.advance(self)
+        return data
+
+    def readinto(self, target):
+        data = self.read(len(target))
+        target[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.shared.close_view(self)
+__all__.append("SharedFileView")
+
+# vim:et:ts=4:sts=4:ai
@@ -8,13 +8,16 @@ from Config import Config
 from S3Uri import S3Uri
 from SortedDict import SortedDict
 from Utils import *
+from Pack import get_index, is_pack_object
+from Exceptions import InvalidFileError
+from HashCache import HashCache
 
 from logging import debug, info, warning, error
 
 import os
 import glob
 
-__all__ = ["fetch_local_list", "fetch_remote_list", "compare_filelists", "filter_exclude_include"]
+__all__ = ["fetch_local_list", "fetch_remote_list", "compare_filelists", "filter_exclude_include", "find_remote_copies", "find_duplicates", "fetch_packed_list", "merge_packed_list", "fetch_original_attribs", "build_attr_header", "parse_attrs_header", "find_local_copies"]
 
 def _fswalk_follow_symlinks(path):
         '''
@@ -117,6 +120,9 @@ def fetch_local_list(args, recursive = None):
                     'full_name' : full_name,
                     'size' : sr.st_size,
                     'mtime' : sr.st_mtime,
+                    'ctime' : sr.st_ctime,
+                    'dev' : sr.st_dev,
+                    'inode' : sr.st_ino,
                     ## TODO: Possibly more to save here...
                 }
         return loc_list, single_file
@@ -154,7 +160,7 @@ def fetch_local_list(args, recursive = None):
 
     return local_list, single_file
 
-def fetch_remote_list(args, require_attribs = False, recursive = None):
+def fetch_remote_list(args, require_attribs = False, recursive = None, config = None):
     def _get_filelist_remote(remote_uri, recursive = True):
         ## If remote_uri ends with '/' then all remote files will have
         ## the remote_uri prefix removed in the relative path.
@@ -173,7 +179,7 @@ def fetch_remote_list(args, require_attribs = False, recursive = None):
 
         info(u"Retrieving list of remote files for %s ..." % remote_uri)
 
-        s3 = S3(Config())
+        s3 = S3(cfg)
         response = s3.bucket_list(remote_uri.bucket(), prefix = remote_uri.object(), recursive = recursive)
 
         rem_base_original = rem_base = remote_uri.object()
@@ -206,7 +212,8 @@ def fetch_remote_list(args, require_attribs = False, recursive = None):
                 break
         return rem_list
 
-    cfg = Config()
+    ## 'config' may be a ProfileConfig for another account or endpoint
+    cfg = config or Config()
     remote_uris = []
     remote_list = SortedDict(ignore_case = False)
 
@@ -267,6 +274,185 @@ def fetch_remote_list(args, require_attribs = False, recursive = None):
                 remote_list[key] = remote_item
     return remote_list
 
+def fetch_packed_list(args, recursive = None):
+    """
+    Like fetch_remote_list() but returns the files packed into archives
+    (see Pack.py) instead of regular objects. Pack indexes are looked up
+    in all parent "directories" of the given URIs, nearer ones take
+    precedence. Wildcards are not supported.
+    """
+    cfg = Config()
+    s3 = S3(cfg)
+    packed_list = SortedDict(ignore_case = False)
+
+    if type(args) not in (list, tuple):
+        args = [args]
+
+    if recursive == None:
+        recursive = cfg.recursive
+
+    for arg in args:
+        uri = S3Uri(arg)
+        if not uri.type == 's3':
+            raise ParameterError("Expecting S3 URI instead of '%s'" % arg)
+        object = uri.object()
+        rem_base = object[:object.rfind('/')+1]
+        dirs = object.split('/')[:-1]
+        for depth in range(len(dirs) + 1):
+            prefix = "".join([dir + '/' for dir in dirs[:depth]])
+            index = get_index(s3, S3Uri(u"s3://%s/%s" % (uri.bucket(), prefix)))
+            for path in index.members:
+                object_key = prefix + path
+                if recursive and object_key.startswith(object):
+                    key = object_key[len(rem_base):]
+                elif object_key == object:
+                    key = os.path.basename(object_key)
+                else:
+                    continue
+                member = index.members[path]
+                packed_list[key] = {
+                    'size' : member['size'],
+                    'md5' : member['md5'],
+                    'object_key' : object_key,
+                    'object_uri_str' : u"s3://%s/%s" % (uri.bucket(), object_key),
+                    'base_uri' : S3Uri(u"s3://%s/%s" % (uri.bucket(), rem_base)),
+                    'archive_uri' : index.archive_uri(path),
+                    'offset' : member['offset'],
+                    'packed' : index,
+                    'packed_path' : path,
+                }
+    return packed_list
+
+def merge_packed_list(remote_list, packed_list):
+    """
+    Remove pack archives and indexes from 'remote_list' and add the
+    items of 'packed_list'. A packed file hides a regular object of
+    the same name, uploads in packing mode keep the index up to date.
+    Returns the updated 'remote_list'.
+    """
+    for key in remote_list.keys():
+        if is_pack_object(remote_list[key]['object_key']):
+            del(remote_list[key])
+    remote_list.update(packed_list)
+    return remote_list
+
+## Headers of an object that a copy with the REPLACE metadata
+## directive would lose unless they are sent again
+_kept_headers = ("content-type", "content-encoding", "content-disposition", "content-language",
+                 "cache-control", "expires", "x-amz-storage-class", "x-amz-server-side-encryption",
+                 "x-amz-website-redirect-location")
+
+def fetch_original_attribs(remote_list, local_list, all_objects = True, config = None, attrs = False):
+    """
+    Objects uploaded with --compress or --encrypt keep the size and
+    MD5 of the original file in their metadata, objects uploaded in
+    parts keep the MD5 that their ETag doesn't tell. Put those into
+    the 'remote_list' items that have a counterpart in 'local_list',
+    so that compare_filelists() compares like with like. Costs one
+    HEAD request per object, with 'all_objects' False only objects
+    uploaded in parts or of another size than their counterpart (as
+    encoded ones are, whatever the current options) are asked for.
+
+    With 'attrs' also objects older than the last status change of
+    their local file are asked for, whose attributes may differ now.
+    Their items get the stored x-amz-meta-s3cmd-attrs in 'attrs' and
+    the headers needed to change them by a copy in 'metadata'.
+    """
+    s3 = S3(config or Config())
+    for key in remote_list:
+        item = remote_list[key]
+        if not local_list.has_key(key) or item.has_key('packed'):
+            continue
+        multipart = item['md5'].find('-') > -1
+        check_attrs = attrs and local_list[key].get('ctime', 0) > item['timestamp']
+        resized = item['size'] != local_list[key]['size']
+        if not all_objects and not multipart and not check_attrs and not resized:
+            continue
+        headers = s3.object_info(S3Uri(item['object_uri_str']))['headers']
+        if attrs:
+            item['attrs'] = headers.get('x-amz-meta-s3cmd-attrs', "")
+            item['stored_size'] = int(headers['content-length'])
+            item['metadata'] = SortedDict(ignore_case = True)
+            for header in headers:
+                if header.startswith("x-amz-meta-") or header in _kept_headers:
+                    item['metadata'][header] = headers[header]
+        if headers.has_key('x-amz-meta-s3cmd-md5'):
+            debug(u"Encoded %s: size=%s md5=%s" % (key, headers['x-amz-meta-s3cmd-size'], headers['x-amz-meta-s3cmd-md5']))
+            item['size'] = int(headers['x-amz-meta-s3cmd-size'])
+            item['md5'] = headers['x-amz-meta-s3cmd-md5']
+            item['encoded'] = True
+        elif multipart and headers.has_key('x-amz-meta-md5sum'):
+            debug(u"Multipart %s: md5=%s" % (key, headers['x-amz-meta-md5sum']))
+            item['md5'] = headers['x-amz-meta-md5sum']
+
+def build_attr_header(src):
+    """
+    Returns the x-amz-meta-s3cmd-attrs header with the attributes of
+    local file 'src' listed in Config.preserve_attrs_list.
+    """
+    import pwd, grp
+    cfg = Config()
+    attrs = {}
+    src = deunicodise(src)
+    try:
+        st = os.stat_result(os.stat(src))
+    except OSError, e:
+        raise InvalidFileError(u"%s: %s" % (unicodise(src), e.strerror))
+    for attr in cfg.preserve_attrs_list:
+        if attr == 'uname':
+            try:
+                val = pwd.getpwuid(st.st_uid).pw_name
+            except KeyError:
+                attr = "uid"
+                val = st.st_uid
+                warning(u"%s: Owner username not known. Storing UID=%d instead." % (unicodise(src), val))
+        elif attr == 'gname':
+            try:
+                val = grp.getgrgid(st.st_gid).gr_name
+            except KeyError:
+                attr = "gid"
+                val = st.st_gid
+                warning(u"%s: Owner groupname not known. Storing GID=%d instead." % (unicodise(src), val))
+        else:
+            val = getattr(st, 'st_' + attr)
+        attrs[attr] = val
+    result = ""
+    for k in attrs: result += "%s:%s/" % (k, attrs[k])
+    return { 'x-amz-meta-s3cmd-attrs' : result[:-1] }
+
+def parse_attrs_header(attrs_header):
+    attrs = {}
+    for attr in attrs_header.split("/"):
+        key, val = attr.split(":")
+        attrs[key] = val
+    return attrs
+
+def attrs_differ(stored, current):
+    """
+    Compare two x-amz-meta-s3cmd-attrs headers. Access and status
+    change times move without anybody changing the file, they don't
+    count, nor do subsecond differences of timestamps.
+    """
+    if not stored:
+        return True
+    try:
+        stored = parse_attrs_header(stored)
+    except ValueError:
+        return True
+    current = parse_attrs_header(current)
+    for attr in current:
+        if attr in ('atime', 'ctime'):
+            continue
+        if attr.endswith("time"):
+            try:
+                if int(float(stored.get(attr, -1))) != int(float(current[attr])):
+                    return True
+            except ValueError:
+                return True
+        elif stored.get(attr) != current[attr]:
+            return True
+    return False
+
 def compare_filelists(src_list, dst_list, src_remote, dst_remote):
     def __direction_str(is_remote):
         return is_remote and "remote" or "local"
@@ -299,16 +485,23 @@ def compare_filelists(src_list, dst_list, src_remote, dst_remote):
             if 'size' in cfg.sync_checks and dst_list[file]['size'] != src_list[file]['size']:
                 debug(u"XFER: %s (size mismatch: src=%s dst=%s)" % (file, src_list[file]['size'], dst_list[file]['size']))
                 attribs_match = False
+                if cfg.append_uploads and src_remote == False and dst_remote == True and \
+                   5 * 1024 * 1024 <= dst_list[file]['size'] < src_list[file]['size'] and \
+                   not dst_list[file].has_key('encoded') and not dst_list[file].has_key('packed'):
+                    ## Maybe it has only grown, see S3.object_put_append()
+                    src_list[file]['append_to'] = dst_list[file]
 
             if attribs_match and 'md5' in cfg.sync_checks:
                 ## ... same size, check MD5
                 try:
                     if src_remote == False and dst_remote == True:
-                        src_md5 = hash_file_md5(src_list[file]['full_name'])
+                        ## Kept in the item for find_remote_copies()
+                        src_md5 = HashCache().md5(src_list[file])
                         dst_md5 = dst_list[file]['md5']
                     elif src_remote == True and dst_remote == False:
                         src_md5 = src_list[file]['md5']
-                        dst_md5 = hash_file_md5(dst_list[file]['full_name'])
+                        ## Kept in the item for find_local_copies()
+                        dst_md5 = HashCache().md5(dst_list[file])
                     elif src_remote == True and dst_remote == True:
                         src_md5 = src_list[file]['md5']
                         dst_md5 = dst_list[file]['md5']
@@ -325,6 +518,18 @@ def compare_filelists(src_list, dst_list, src_remote, dst_remote):
                     attribs_match = False
                     debug(u"XFER: %s (md5 mismatch: src=%s dst=%s)" % (file, src_md5, dst_md5))
 
+            if attribs_match and dst_list[file].has_key('attrs') and cfg.preserve_attrs:
+                ## Same content, see if just the attributes need an update
+                try:
+                    current = build_attr_header(src_list[file]['full_name'])['x-amz-meta-s3cmd-attrs']
+                    if attrs_differ(dst_list[file]['attrs'], current):
+                        debug(u"ATTR: %s (attributes changed: src=%s dst=%s)" % (file, current, dst_list[file]['attrs']))
+                        src_list[file]['attrs_only'] = dst_list[file]
+                        del(dst_list[file])
+                        continue
+                except InvalidFileError, e:
+                    debug(u"IGNR: %s (%s)" % (file, e))
+
             if attribs_match:
                 ## Remove from source-list, all that is left there will be transferred
                 debug(u"IGNR: %s (transfer not needed)" % file)
@@ -336,4 +541,132 @@ def compare_filelists(src_list, dst_list, src_remote, dst_remote):
 
     return src_list, dst_list, exists_list
 
+def find_remote_copies(local_list, remote_list):
+    """
+    Look for files in 'local_list' whose content is already stored in
+    some object of 'remote_list' (same size and MD5), typically because
+    they were moved or renamed locally. Such files can be copied on
+    the server side instead of uploaded.
+
+    Sets 'copy_source' of matching 'local_list' items to the remote item
+    and returns their number. Objects uploaded in multiple parts have
+    no MD5 in their ETag and are never matched.
+    """
+    by_size = {}
+    for key in remote_list:
+        item = remote_list[key]
+        if item['size'] and item['md5'].find('-') < 0 and not item.has_key('packed') and not item.has_key('encoded'):
+            by_size.setdefault(item['size'], []).append(item)
+
+    count = 0
+    for key in local_list:
+        item = local_list[key]
+        if not by_size.has_key(item['size']):
+            continue
+        if not item.has_key('md5'):
+            try:
+                HashCache().md5(item)
+            except (IOError, OSError):
+                ## The upload will report it
+                continue
+        for remote_item in by_size[item['size']]:
+            if remote_item['md5'] == item['md5']:
+                debug(u"COPY: %s (same content as %s)" % (key, remote_item['object_uri_str']))
+                item['copy_source'] = remote_item
+                count += 1
+                break
+    return count
+
+def find_local_copies(remote_list, local_list):
+    """
+    Look for objects in 'remote_list' whose content is already in some
+    file of 'local_list' (same size and MD5), typically because the
+    local tree was reorganised since. Such objects can be copied
+    locally instead of downloaded. Only files whose size matches an
+    object are hashed, through the HashCache.
+
+    Sets 'local_source' of matching 'remote_list' items to the local
+    item and returns their number. Objects uploaded in multiple parts
+    with no MD5 known are never matched.
+    """
+    by_size = {}
+    for key in local_list:
+        item = local_list[key]
+        if item['size']:
+            by_size.setdefault(item['size'], []).append(item)
+
+    count = 0
+    for key in remote_list:
+        item = remote_list[key]
+        if not by_size.has_key(item['size']) or item['md5'].find('-') > -1:
+            continue
+        for local_item in by_size[item['size']]:
+            try:
+                local_md5 = HashCache().md5(local_item)
+            except (IOError, OSError):
+                continue
+            if local_md5 == item['md5']:
+                debug(u"LOCAL: %s (same content as %s)" % (key, local_item['full_name_unicode']))
+                item['local_source'] = local_item
+                count += 1
+                break
+    return count
+
+def find_duplicates(local_list):
+    """
+    Group files in 'local_list' with identical content, so that each
+    content is uploaded only once and the other files are copied from
+    it on the server side. Hard links are recognised by their inode,
+    other files by size and MD5. Only files whose size isn't unique
+    need to be hashed. Files with 'copy_source' (see find_remote_copies())
+    are left alone.
+
+    Sets 'dedup_source' of each duplicate to the key of the file to be
+    uploaded with the same content and returns the number of duplicates.
+    """
+    by_inode = {}
+    by_size = {}
+    keys = local_list.keys()
+    keys.sort()
+    for key in keys:
+        item = local_list[key]
+        if not item['size'] or item.has_key('copy_source'):
+            continue
+        inode = (item['dev'], item['inode'])
+        if by_inode.has_key(inode):
+            debug(u"DUPL: %s (hard link of %s)" % (key, by_inode[inode]))
+            item['dedup_source'] = by_inode[inode]
+            continue
+        by_inode[inode] = key
+        by_size.setdefault(item['size'], []).append(key)
+
+    for size in by_size:
+        if len(by_size[size]) < 2:
+            continue
+        by_md5 = {}
+        for key in by_size[size]:
+            item = local_list[key]
+            if not item.has_key('md5'):
+                try:
+                    HashCache().md5(item)
+                except (IOError, OSError):
+                    ## The upload will report it
+                    continue
+            if by_md5.has_key(item['md5']):
+                debug(u"DUPL: %s (same content as %s)" % (key, by_md5[item['md5']]))
+                item['dedup_source'] = by_md5[item['md5']]
+            else:
+                by_md5[item['md5']] = key
+
+    ## A hard link may point to a file that's a duplicate itself
+    count = 0
+    for key in keys:
+        item = local_list[key]
+        if not item.has_key('dedup_source'):
+            continue
+        while local_list[item['dedup_source']].has_key('dedup_source'):
+            item['dedup_source'] = local_list[item['dedup_source']]['dedup_source']
+        count += 1
+    return count
+
 # vim:et:ts=4:sts=4:ai
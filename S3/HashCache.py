@@ -0,0 +1,101 @@
+## Amazon S3 manager - MD5 sums of local files kept between runs
+## Author: Michal Ludvig <michal@logix.cz>
+##         http://www.logix.cz/michal
+## License: GPL Version 2
+
+import os
+import threading
+import cPickle as pickle
+from logging import debug, info, warning, error
+
+from Config import Config
+from Utils import hash_file_md5, unicodise
+
+__all__ = []
+
+class HashCache(object):
+    """
+    MD5 sums of local files by device and inode, valid as long as
+    size, mtime and ctime stay the same. Any change of the content
+    moves mtime and ctime, so stale sums are never used.
+
+    Loaded from Config.cache_file on first use and written back by
+    save(), with no cache file the sums are kept for this run only.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    ## Creating a singleton, threads may ask for it at the same time
+    def __new__(self):
+        self._instance_lock.acquire()
+        try:
+            if self._instance is None:
+                self._instance = object.__new__(self)
+                self._instance._initialized = False
+        finally:
+            self._instance_lock.release()
+        return self._instance
+
+    def __init__(self):
+        self._instance_lock.acquire()
+        try:
+            if not self._initialized:
+                self._init()
+                self._initialized = True
+        finally:
+            self._instance_lock.release()
+
+    def _init(self):
+        self.filename = Config().cache_file
+        self.hashes = {}
+        self.changed = False
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            f = open(self.filename, "rb")
+            try:
+                self.hashes = pickle.load(f)
+            finally:
+                f.close()
+            debug(u"HashCache: %d sums loaded from %s" % (len(self.hashes), unicodise(self.filename)))
+        except Exception, e:
+            warning(u"Ignoring unreadable cache file %s: %s" % (unicodise(self.filename), e))
+            self.hashes = {}
+
+    def md5(self, item):
+        """
+        Returns the MD5 of local list item 'item', from the cache if
+        the file hasn't changed since, and keeps it in item['md5'].
+        """
+        if item.has_key('md5'):
+            return item['md5']
+        key = (item['dev'], item['inode'])
+        stamp = (item['size'], item['mtime'], item.get('ctime'))
+        cached = self.hashes.get(key)
+        if cached and cached[0] == stamp:
+            item['md5'] = cached[1]
+            return item['md5']
+        item['md5'] = hash_file_md5(item['full_name'])
+        self.hashes[key] = (stamp, item['md5'])
+        self.changed = True
+        return item['md5']
+
+    def save(self):
+        if not self.filename or not self.changed:
+            return
+        tmp_filename = self.filename + ".tmp"
+        try:
+            f = open(tmp_filename, "wb")
+            try:
+                pickle.dump(self.hashes, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmp_filename, self.filename)
+        except (IOError, OSError), e:
+            warning(u"Can't write cache file %s: %s" % (unicodise(self.filename), e))
+            return
+        self.changed = False
+        debug(u"HashCache: %d sums saved to %s" % (len(self.hashes), unicodise(self.filename)))
+__all__.append("HashCache")
+
+# vim:et:ts=4:sts=4:ai
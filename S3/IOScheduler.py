@@ -0,0 +1,174 @@
+## Amazon S3 manager - reading local files in disk order
+## Author: Michal Ludvig <michal@logix.cz>
+##         http://www.logix.cz/michal
+## License: GPL Version 2
+
+import os
+import sys
+import struct
+import threading
+from logging import debug, info, warning, error
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from Utils import fadvise, POSIX_FADV_WILLNEED, unicodise
+
+__all__ = []
+
+## _IOWR('f', 11, struct fiemap) from linux/fs.h
+FS_IOC_FIEMAP = 0xC020660B
+## struct fiemap header and one struct fiemap_extent
+_fiemap_header = "=QQLLLL"
+_fiemap_extent = "=QQQQQLLLL"
+## fe_flags of extents with no place on the disk (yet)
+FIEMAP_EXTENT_UNKNOWN = 0x02
+FIEMAP_EXTENT_DELALLOC = 0x04
+
+def physical_offset(filename):
+    """
+    Where on the disk 'filename' starts, from the FIEMAP ioctl, or
+    None if the filesystem doesn't tell (or the file is empty).
+    """
+    if not fcntl or not sys.platform.startswith("linux"):
+        return None
+    request = struct.pack(_fiemap_header, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+    request += "\0" * struct.calcsize(_fiemap_extent)
+    try:
+        f = open(filename, "rb")
+        try:
+            result = fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, request)
+        finally:
+            f.close()
+    except (IOError, OSError), e:
+        debug(u"FIEMAP of %s failed: %s" % (unicodise(filename), e))
+        return None
+    mapped_extents = struct.unpack(_fiemap_header, result[:struct.calcsize(_fiemap_header)])[3]
+    if not mapped_extents:
+        return None
+    extent = struct.unpack(_fiemap_extent, result[struct.calcsize(_fiemap_header):])
+    if extent[5] & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_DELALLOC):
+        return None
+    return extent[1]
+__all__.append("physical_offset")
+
+def disk_order(items, method):
+    """
+    Sort local list items by where their data are likely to be on
+    the disk, so that reading them one after another doesn't seek
+    back and forth: by "inode" number, which most filesystems
+    allocate close to the data, or by the physical "extent" the
+    data start at, for files whose filesystem tells (inode order
+    for the others). Returns a new list.
+    """
+    keyed = []
+    for item in items:
+        position = None
+        if method == "extent":
+            position = physical_offset(item['full_name'])
+        if position is None:
+            keyed.append(((item['dev'], 1, item['inode']), item))
+        else:
+            keyed.append(((item['dev'], 0, position), item))
+    keyed.sort()
+    return [item for key, item in keyed]
+__all__.append("disk_order")
+
+class Prefetcher(object):
+    """
+    Prefetcher(files, window)
+
+    Gets the files that are about to be read into the page cache in
+    the background, up to 'window' bytes ahead of the one being read.
+    'files' is a list of (filename, size) in the order they will be
+    read. Call advance() as each of them is taken up and close() at
+    the end. The kernel reads them ahead on posix_fadvise(WILLNEED),
+    where that's missing a thread reads them.
+    """
+    def __init__(self, files, window):
+        self.files = files
+        self.window = window
+        self.current = -1
+        self.next = 0
+        ## Bytes prefetched after the current file
+        self.ahead = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target = self._prefetch)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def advance(self):
+        self.cond.acquire()
+        self.current += 1
+        if self.current < self.next:
+            self.ahead -= self.files[self.current][1]
+        else:
+            self.next = self.current + 1
+            self.ahead = 0
+        self.cond.notifyAll()
+        self.cond.release()
+
+    def close(self):
+        self.cond.acquire()
+        self.closed = True
+        self.cond.notifyAll()
+        self.cond.release()
+
+    def _prefetch(self):
+        while True:
+            self.cond.acquire()
+            while not self.closed and (self.next >= len(self.files) or self.ahead >= self.window):
+                self.cond.wait()
+            if self.closed:
+                self.cond.release()
+                return
+            filename, size = self.files[self.next]
+            length = min(size, self.window - self.ahead)
+            self.next += 1
+            self.ahead += size
+            self.cond.release()
+            self._fetch(filename, length)
+
+    def _fetch(self, filename, length):
+        try:
+            f = open(filename, "rb")
+            try:
+                if not fadvise(f.fileno(), 0, length, POSIX_FADV_WILLNEED):
+                    while length > 0:
+                        data = f.read(min(length, 1024 * 1024))
+                        if not data:
+                            break
+                        length -= len(data)
+            finally:
+                f.close()
+        except (IOError, OSError), e:
+            ## The upload will report it
+            debug(u"Prefetch of %s failed: %s" % (unicodise(filename), e))
+__all__.append("Prefetcher")
+
+class InOrder(object):
+    """
+    InOrder(emit, first = 1)
+
+    Passes messages on to emit() in the order of their sequence
+    numbers, holding back those that arrive before their turn.
+    done() must be called for every number, with no message for
+    those that have nothing to say.
+    """
+    def __init__(self, emit, first = 1):
+        self.emit = emit
+        self.next = first
+        self.pending = {}
+
+    def done(self, seq, *messages):
+        self.pending[seq] = messages
+        while self.pending.has_key(self.next):
+            for message in self.pending.pop(self.next):
+                self.emit(message)
+            self.next += 1
+__all__.append("InOrder")
+
+# vim:et:ts=4:sts=4:ai
@@ -0,0 +1,197 @@
+## Amazon S3 manager - small file packing
+## Author: Michal Ludvig <michal@logix.cz>
+##         http://www.logix.cz/michal
+## License: GPL Version 2
+
+import os
+import time
+import tarfile
+from cStringIO import StringIO
+from logging import debug, info, warning, error
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from Config import Config
+from S3Uri import S3Uri
+from SortedDict import SortedDict
+from Exceptions import S3Error
+from Utils import *
+
+## Archives and the index live in this "directory"
+## right under the prefix the files were stored to
+pack_dir = ".s3cmd-pack"
+__all__ = ["pack_dir"]
+
+class PackIndex(object):
+    """
+    PackIndex(base_uri)
+
+    Index of the files packed into archives under 'base_uri', which
+    must end with '/'. Every member path, relative to 'base_uri',
+    maps to the archive holding it and to the offset, length and MD5
+    of its data in there, so that a member can be fetched with a
+    single ranged GET. The index is a text object with one line
+    "archive<TAB>offset<TAB>length<TAB>md5<TAB>path" per member.
+    """
+    header = "# s3cmd pack index 1\n"
+
+    def __init__(self, base_uri):
+        self.base_uri = base_uri
+        self.uri = S3Uri(base_uri.uri() + pack_dir + "/index")
+        self.members = SortedDict(ignore_case = False)
+        self.changed = False
+
+    def load(self, s3):
+        """
+        Read the index from S3. Returns False if there is none yet.
+        """
+        try:
+            response = s3.send_request(s3.create_request("OBJECT_GET", uri = self.uri))
+        except S3Error, e:
+            if e.status == 404:
+                return False
+            raise
+        for line in response["data"].splitlines():
+            if not line or line.startswith("#"):
+                continue
+            try:
+                archive, offset, length, md5sum, path = line.split("\t", 4)
+                self.members[path.decode("utf-8")] = {
+                    'archive' : archive,
+                    'offset' : int(offset),
+                    'size' : int(length),
+                    'md5' : md5sum,
+                }
+            except ValueError:
+                warning(u"%s: Ignoring invalid index line: %s" % (self.uri, unicodise(line)))
+        debug(u"Loaded %d packed files from %s" % (len(self.members), self.uri))
+        return True
+
+    def save(self, s3):
+        filename = mktmpfile()
+        try:
+            f = open(filename, "wb")
+            f.write(self.header)
+            for path in self.members:
+                member = self.members[path]
+                f.write("%s\t%d\t%d\t%s\t%s\n" % (member['archive'], member['offset'],
+                        member['size'], member['md5'], path.encode("utf-8")))
+            f.close()
+            s3.object_put(filename, self.uri, extra_label = "[index]")
+        finally:
+            os.remove(filename)
+        self.changed = False
+
+    def add(self, path, archive, offset, length, md5sum):
+        self.members[path] = {
+            'archive' : archive,
+            'offset' : offset,
+            'size' : length,
+            'md5' : md5sum,
+        }
+        self.changed = True
+
+    def remove(self, path):
+        if self.members.has_key(path):
+            del(self.members[path])
+            self.changed = True
+
+    def archive_uri(self, path):
+        return S3Uri(self.base_uri.uri() + self.members[path]['archive'])
+__all__.append("PackIndex")
+
+_indexes = {}
+
+def get_index(s3, base_uri):
+    """
+    Return the PackIndex for 'base_uri', loading it on first use.
+    Later calls return the same object so that all changes end
+    up in one index.
+    """
+    base = base_uri.uri()
+    if not _indexes.has_key(base):
+        index = PackIndex(base_uri)
+        index.exists = index.load(s3)
+        _indexes[base] = index
+    return _indexes[base]
+__all__.append("get_index")
+
+def save_indexes(s3):
+    for base in _indexes:
+        if _indexes[base].changed:
+            _indexes[base].save(s3)
+__all__.append("save_indexes")
+
+def is_pack_object(object_key):
+    return ("/" + object_key).find("/" + pack_dir + "/") > -1
+__all__.append("is_pack_object")
+
+def split_packable(local_list):
+    """
+    Move the files small enough for packing from
+    'local_list' to a new list and return that one.
+    """
+    cfg = Config()
+    pack_list = SortedDict(ignore_case = False)
+    for key in local_list.keys():
+        item = local_list[key]
+        if item['size'] >= cfg.pack_threshold or item.has_key('copy_source'):
+            continue
+        if key.find("\n") > -1 or is_pack_object(key):
+            continue
+        pack_list[key] = item
+        del(local_list[key])
+    return pack_list
+__all__.append("split_packable")
+
+def pack_files(pack_list, max_size):
+    """
+    Pack the files of 'pack_list' into tar archives of about 'max_size'
+    bytes. The archives can be unpacked with any tar, s3cmd itself only
+    needs the index to get a member back. Yields (archive, filename,
+    members) for each archive, where 'archive' is its name relative to
+    the index base, 'filename' a temporary file that the caller has to
+    remove and 'members' a list of (path, offset, length, md5) tuples.
+    """
+    prefix = "%s/%s-%d" % (pack_dir, time.strftime("%Y%m%d-%H%M%S"), os.getpid())
+    seq = 0
+    tar = None
+    for key in pack_list:
+        item = pack_list[key]
+        if tar is None:
+            seq += 1
+            archive = "%s-%04d.tar" % (prefix, seq)
+            filename = mktmpfile()
+            tar = tarfile.open(filename, "w")
+            tar.dereference = True
+            members = []
+        try:
+            f = open(item['full_name'], "rb")
+            data = f.read()
+            f.close()
+            tarinfo = tar.gettarinfo(item['full_name'], key.encode("utf-8"))
+        except (IOError, OSError), e:
+            warning(u"%s: %s, skipping" % (item['full_name_unicode'], e.strerror))
+            continue
+        tarinfo.size = len(data)
+        tar.addfile(tarinfo, StringIO(data))
+        ## The data are padded to whole blocks after the header
+        offset = tar.offset - (len(data) + tarfile.BLOCKSIZE - 1) / tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+        members.append((key, offset, len(data), md5(data).hexdigest()))
+        debug(u"Packed %s into %s at %d" % (key, archive, offset))
+        if tar.offset >= max_size:
+            tar.close()
+            tar = None
+            yield archive, filename, members
+    if tar is not None:
+        tar.close()
+        if members:
+            yield archive, filename, members
+        else:
+            os.remove(filename)
+__all__.append("pack_files")
+
+# vim:et:ts=4:sts=4:ai
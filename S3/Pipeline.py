@@ -0,0 +1,212 @@
+## Amazon S3 manager - pipelined transfer I/O
+## Author: Michal Ludvig <michal@logix.cz>
+##         http://www.logix.cz/michal
+## License: GPL Version 2
+
+import time
+import threading
+import Queue
+from logging import debug, info, warning, error
+
+from BufferPool import BufferPool
+
+try:
+    bytearray, memoryview
+    pipeline_available = True
+except NameError:
+    ## Python < 2.7 - callers fall back to plain read()/write() loops
+    pipeline_available = False
+
+__all__ = [ "Pipeline", "ChunkSizer", "response_reader", "pipeline_available" ]
+
+class ChunkSizer(object):
+    """
+    Picks a chunk size from the measured throughput so that
+    every chunk takes roughly 'interval' seconds to move.
+    Slow links get small chunks (and a smooth progress meter),
+    fast ones get big chunks and fewer system calls.
+    """
+    def __init__(self, min_size, max_size, interval = 0.05):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.interval = interval
+        self.size = min_size
+        self.rate = 0.0
+
+    def update(self, nbytes, elapsed):
+        if elapsed <= 0:
+            self.size = self.max_size
+            return
+        rate = nbytes / elapsed
+        if self.rate:
+            rate = self.rate * 0.7 + rate * 0.3
+        self.rate = rate
+        self.size = int(max(self.min_size, min(self.max_size, rate * self.interval)))
+
+class Pipeline(object):
+    """
+    Pipeline(read_into, write, min_chunk, max_chunk, buffers)
+
+    Move data from read_into() to write() through up to 'buffers'
+    buffers from the BufferPool. Reading, MD5 hashing and writing each
+    run in their own thread, so that disk reads, hashing and network
+    I/O (or the other way around for downloads) overlap. Only the first
+    buffer waits for the memory budget, the others are taken while
+    there is room and the transfer makes do with fewer otherwise.
+
+    read_into(view) stores up to len(view) bytes in a writable
+    memoryview and returns their number, 0 at EOF. Each chunk is
+    passed on as soon as read_into() returns, so that a slow
+    network doesn't keep a large buffer half full. write(data) gets a read-only
+    buffer object that is only valid during the call. If 'limiter'
+    is given (see RateLimit.TokenBucket) every chunk is accounted
+    with it before being written, 'monitor' (RateLimit.SpeedMonitor)
+    is updated after each write.
+    """
+    def __init__(self, read_into, write, min_chunk, max_chunk, buffers = 4, limiter = None, monitor = None):
+        self.read_into = read_into
+        self.write = write
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.buffers = buffers
+        self.limiter = limiter
+        self.monitor = monitor
+        self.aborted = False
+        self.transferred = 0
+        self.allocated = []
+        self.lock = threading.Lock()
+        self.running = 0
+
+    def run(self, size, md5_hash = None, progress = None):
+        """
+        Transfer up to 'size' bytes, updating 'md5_hash' and 'progress'
+        on the way. Returns the number of bytes transferred, which is
+        less than 'size' only if read_into() hit EOF early. If an
+        exception is raised, self.transferred tells how many bytes
+        were written before.
+        """
+        if size <= 0:
+            return 0
+        buffer_size = min(self.max_chunk, size)
+        max_buffers = min(self.buffers, (size + buffer_size - 1) / buffer_size)
+        free_queue = Queue.Queue()
+        self.allocated = [BufferPool().get(buffer_size)]
+        free_queue.put(self.allocated[0])
+        sizer = ChunkSizer(min(self.min_chunk, buffer_size), buffer_size)
+        read_queue = Queue.Queue()
+        write_queue = Queue.Queue()
+
+        ## Buffers go back to the pool once both the reader and
+        ## this thread are done with them, whichever comes last
+        self.running = 2
+        reader = threading.Thread(target = self._reader, args = (size, sizer, free_queue, read_queue, buffer_size, max_buffers))
+        hasher = threading.Thread(target = self._hasher, args = (md5_hash, read_queue, write_queue))
+        for thread in (reader, hasher):
+            thread.setDaemon(True)
+            thread.start()
+
+        self.transferred = 0
+        timestamp = time.time()
+        try:
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                data, nbytes = item
+                if self.limiter:
+                    self.limiter.consume(nbytes)
+                self.write(buffer(data, 0, nbytes))
+                self.transferred += nbytes
+                if self.monitor:
+                    self.monitor.update(nbytes)
+                now = time.time()
+                sizer.update(nbytes, now - timestamp)
+                timestamp = now
+                if progress:
+                    progress.update(delta_position = nbytes)
+                free_queue.put(data)
+        except:
+            ## Wake up the reader so that both threads terminate
+            self.aborted = True
+            free_queue.put(None)
+            self._release()
+            raise
+        self._release()
+        return self.transferred
+
+    def _release(self):
+        self.lock.acquire()
+        self.running -= 1
+        last = self.running == 0
+        self.lock.release()
+        if last:
+            pool = BufferPool()
+            for data in self.allocated:
+                pool.put(data)
+            self.allocated = []
+
+    def _next_buffer(self, free_queue, buffer_size, max_buffers):
+        try:
+            return free_queue.get_nowait()
+        except Queue.Empty:
+            pass
+        if len(self.allocated) < max_buffers:
+            data = BufferPool().get(buffer_size, wait = False)
+            if data is not None:
+                self.allocated.append(data)
+                return data
+        return free_queue.get()
+
+    def _reader(self, size, sizer, free_queue, read_queue, buffer_size, max_buffers):
+        size_left = size
+        try:
+            while size_left > 0:
+                data = self._next_buffer(free_queue, buffer_size, max_buffers)
+                if data is None or self.aborted:
+                    break
+                wanted = min(sizer.size, size_left)
+                nbytes = self.read_into(memoryview(data)[:wanted])
+                if not nbytes:
+                    break
+                read_queue.put((data, nbytes))
+                size_left -= nbytes
+        except Exception, e:
+            read_queue.put(e)
+        read_queue.put(None)
+        self._release()
+
+    def _hasher(self, md5_hash, read_queue, write_queue):
+        while True:
+            item = read_queue.get()
+            if item is not None and not isinstance(item, Exception) and md5_hash:
+                data, nbytes = item
+                md5_hash.update(buffer(data, 0, nbytes))
+            write_queue.put(item)
+            if item is None or isinstance(item, Exception):
+                return
+
+def response_reader(http_response):
+    """
+    Returns a read_into() function for the body of an httplib response.
+
+    httplib reads the response headers byte by byte, so unless the
+    body is chunked nothing of it has been buffered yet and we can
+    recv_into() the caller's buffer right from the socket. Otherwise
+    fall back to copying the output of HTTPResponse.read().
+    """
+    sock = getattr(http_response.fp, "_sock", None)
+    buffered = getattr(http_response.fp, "_rbuf", "")
+    if hasattr(buffered, "getvalue"):
+        buffered = buffered.getvalue()
+    if not http_response.chunked and not buffered and hasattr(sock, "recv_into"):
+        return sock.recv_into
+
+    def read_into(view):
+        data = http_response.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+    return read_into
+
+# vim:et:ts=4:sts=4:ai
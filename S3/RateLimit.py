@@ -0,0 +1,233 @@
+## Amazon S3 manager - bandwidth limiting
+## Author: Michal Ludvig <michal@logix.cz>
+##         http://www.logix.cz/michal
+## License: GPL Version 2
+
+import os
+import re
+import time
+import socket
+import threading
+from logging import debug, info, warning, error
+
+from Config import Config
+from Utils import parse_size
+from Exceptions import S3TransferTooSlow, S3TransferCancelled
+
+class TokenBucket(object):
+    """
+    TokenBucket(rate)
+
+    Thread-safe token bucket limiting throughput to 'rate' bytes
+    per second (0 means unlimited). All transfers sharing a bucket
+    share its bandwidth. consume() takes the tokens right away,
+    possibly going into debt, and then sleeps until the debt is
+    paid, so that concurrent callers queue up fairly.
+    """
+    burst_time = 0.25
+
+    def __init__(self, rate = 0):
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.timestamp = time.time()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.lock.acquire()
+        try:
+            self.rate = rate
+            self.burst = rate * self.burst_time
+            self.tokens = min(self.tokens, self.burst)
+        finally:
+            self.lock.release()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate
+        finally:
+            self.lock.release()
+        if wait > 0:
+            time.sleep(wait)
+
+    def chunk_size(self, default):
+        """
+        Largest chunk worth sending in one go at the current rate.
+        Keeps rate-limited transfers smooth instead of bursty.
+        """
+        if not self.rate:
+            return default
+        return max(4096, min(default, int(self.burst)))
+
+class BandwidthLimit(object):
+    """
+    Aggregate upload and download limits shared by all transfers.
+
+    Limits come from Config (limit_rate_up / limit_rate_down) and
+    can be changed at runtime through Config.limit_rate_file. The
+    file is re-read when it changes and after request_reload()
+    (SIGUSR1).
+    It contains lines like "up = 1M", "down = 500k" or "rate = 2M".
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+    check_interval = 1.0
+    ## Set by request_reload(), picked up by the watcher thread
+    reload_requested = False
+
+    ## Creating a singleton, threads may ask for it at the same time
+    def __new__(self):
+        self._instance_lock.acquire()
+        try:
+            if self._instance is None:
+                self._instance = object.__new__(self)
+                self._instance._initialized = False
+        finally:
+            self._instance_lock.release()
+        return self._instance
+
+    def __init__(self):
+        self._instance_lock.acquire()
+        try:
+            if not self._initialized:
+                self._init()
+                self._initialized = True
+        finally:
+            self._instance_lock.release()
+
+    def _init(self):
+        cfg = Config()
+        self.up = TokenBucket(cfg.limit_rate_up)
+        self.down = TokenBucket(cfg.limit_rate_down)
+        self.file_mtime = None
+        if cfg.limit_rate_file:
+            self.check_file()
+            watcher = threading.Thread(target = self._watch_file)
+            watcher.setDaemon(True)
+            watcher.start()
+
+    def upload(self):
+        return self.up
+
+    def download(self):
+        return self.down
+
+    def check_file(self):
+        try:
+            mtime = os.stat(Config().limit_rate_file).st_mtime
+        except OSError:
+            return
+        if mtime != self.file_mtime:
+            self.file_mtime = mtime
+            self.reload()
+
+    def _watch_file(self):
+        while True:
+            time.sleep(self.check_interval)
+            if BandwidthLimit.reload_requested:
+                BandwidthLimit.reload_requested = False
+                self.reload()
+            self.check_file()
+
+    def reload(self):
+        filename = Config().limit_rate_file
+        if not filename:
+            return
+        try:
+            f = open(filename, "r")
+        except IOError, e:
+            warning(u"Can't read %s: %s" % (filename, e.strerror))
+            return
+        r_data = re.compile("^\s*(?P<key>\w+)\s*=\s*(?P<value>\S+)")
+        for line in f:
+            is_data = r_data.match(line)
+            if not is_data:
+                continue
+            key, value = is_data.group("key"), is_data.group("value")
+            try:
+                rate = parse_size(value)
+            except ValueError:
+                warning(u"Ignoring invalid line in '%s': %s" % (filename, line.strip()))
+                continue
+            if key in ("up", "rate"):
+                self.up.set_rate(rate)
+            if key in ("down", "rate"):
+                self.down.set_rate(rate)
+        f.close()
+        info(u"Bandwidth limits: up=%d B/s down=%d B/s (0 = unlimited)" % (self.up.rate, self.down.rate))
+
+def request_reload(signum = None, frame = None):
+    """
+    Signal handler asking for the limit file to be re-read. The
+    reload itself happens in the watcher thread, a handler taking
+    the locks of the token buckets could interrupt their holder.
+    """
+    BandwidthLimit.reload_requested = True
+
+class SpeedMonitor(object):
+    """
+    SpeedMonitor(limit, period)
+
+    Watches the throughput of one request. update() raises
+    S3TransferTooSlow when less than 'limit' bytes/sec went through
+    during the last 'period' seconds and S3TransferCancelled once
+    somebody called cancel(). A monitor may be reused for retries of
+    the same request, start() must be called for every connection.
+    """
+    def __init__(self, limit = 0, period = 30):
+        self.limit = limit
+        self.period = period
+        self.cancelled = False
+        self.sock = None
+
+    def start(self, conn):
+        """
+        Start watching a new connection. A connection that doesn't
+        deliver anything for 'period' seconds is certainly too slow,
+        so make its socket time out by then.
+        """
+        if self.cancelled:
+            raise S3TransferCancelled("Transfer cancelled")
+        self.sock = conn.sock
+        self.window_start = time.time()
+        self.window_bytes = 0
+        if self.limit and self.sock:
+            timeout = self.sock.gettimeout()
+            if timeout is None or timeout > self.period:
+                self.sock.settimeout(self.period)
+
+    def update(self, nbytes):
+        if self.cancelled:
+            raise S3TransferCancelled("Transfer cancelled")
+        if not self.limit:
+            return
+        self.window_bytes += nbytes
+        now = time.time()
+        elapsed = now - self.window_start
+        if elapsed >= self.period:
+            speed = self.window_bytes / elapsed
+            if speed < self.limit:
+                raise S3TransferTooSlow("Transfer too slow: %d B/s for %d sec (low_speed_limit = %d B/s)" % (speed, elapsed, self.limit))
+            self.window_start = now
+            self.window_bytes = 0
+
+    def cancel(self):
+        """
+        Abort the transfer from another thread. Shutting the socket
+        down wakes up a thread blocked in recv() or send().
+        """
+        self.cancelled = True
+        sock = self.sock
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, AttributeError):
+                pass
+
+# vim:et:ts=4:sts=4:ai
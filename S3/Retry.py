@@ -0,0 +1,158 @@
+## Amazon S3 manager - retry policy
+## Author: Michal Ludvig <michal@logix.cz>
+##         http://www.logix.cz/michal
+## License: GPL Version 2
+
+import time
+import random
+import threading
+from logging import debug, info, warning, error
+
+from Config import Config
+from Exceptions import S3Error, S3TransferTooSlow, S3TransferCancelled, S3DecodeError
+
+class RetryPolicy(object):
+    """
+    Retry policy shared by all requests of one s3cmd command.
+
+    Failed requests are retried after a random delay between 0 and
+    retry_delay * 2^attempt seconds, capped at retry_max_delay
+    ("full jitter" exponential backoff), at most max_retries times
+    per request. All threads draw from one budget of retry_budget
+    retries so that a broken endpoint can't keep a large sync busy
+    forever. Every successful request returns a tenth of a retry
+    to the budget.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    ## strategy -> backoff multiplier (0 = retry right away)
+    strategies = {
+        "connection" : 1,   # Connection reset, timeout, ...
+        "slow" : 0,         # Below low_speed_limit - reconnect right away
+        "server" : 1,       # 5xx and other transient server errors
+        "throttle" : 4,     # SlowDown - back off harder
+        "timeout" : 0,      # RequestTimeout - we were too slow, just resend
+        "digest" : 0,       # BadDigest or MD5 mismatch - data corrupted on the way
+    }
+
+    ## Creating a singleton, threads may ask for it at the same time
+    def __new__(self):
+        self._instance_lock.acquire()
+        try:
+            if self._instance is None:
+                self._instance = object.__new__(self)
+                self._instance._initialized = False
+        finally:
+            self._instance_lock.release()
+        return self._instance
+
+    def __init__(self):
+        self._instance_lock.acquire()
+        try:
+            if not self._initialized:
+                self._init()
+                self._initialized = True
+        finally:
+            self._instance_lock.release()
+
+    def _init(self):
+        cfg = Config()
+        self.max_retries = cfg.max_retries
+        self.delay = cfg.retry_delay
+        self.max_delay = cfg.retry_max_delay
+        self.budget_size = float(cfg.retry_budget)
+        self.budget = self.budget_size
+        self.lock = threading.Lock()
+
+    def begin(self, label, max_retries = None):
+        """
+        Returns retry state for one request. 'label' is
+        used in messages, usually the URI of the request.
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        return Retry(self, label, max_retries)
+
+    def classify(self, error):
+        """
+        Returns the strategy for 'error' or None
+        if it's not worth retrying at all.
+        """
+        if isinstance(error, (S3TransferCancelled, S3DecodeError)):
+            return None
+        if isinstance(error, S3TransferTooSlow):
+            return "slow"
+        if isinstance(error, S3Error):
+            if error.code == "SlowDown" or error.status == 503:
+                return "throttle"
+            if error.code == "RequestTimeout":
+                return "timeout"
+            if error.code == "BadDigest":
+                return "digest"
+            if error.status >= 500 or error.code in ("OperationAborted", "TokenRefreshRequired"):
+                return "server"
+            return None
+        ## Anything else (socket.error, httplib.HTTPException,
+        ## IOError, ...) is treated as a connection problem
+        return "connection"
+
+    def backoff(self, attempt, strategy):
+        ceiling = min(self.max_delay, self.delay * self.strategies[strategy] * 2 ** attempt)
+        return random.uniform(0, ceiling)
+
+    def take(self):
+        self.lock.acquire()
+        try:
+            if self.budget < 1:
+                return False
+            self.budget -= 1
+            return True
+        finally:
+            self.lock.release()
+
+    def refund(self):
+        self.lock.acquire()
+        try:
+            self.budget = min(self.budget_size, self.budget + 0.1)
+        finally:
+            self.lock.release()
+
+class Retry(object):
+    """
+    Retry state of a single request, see RetryPolicy.begin()
+    """
+    def __init__(self, policy, label, max_retries):
+        self.policy = policy
+        self.label = label
+        self.max_retries = max_retries
+        self.attempt = 0
+
+    def again(self, error, strategy = None):
+        """
+        Decide whether to retry after 'error'. If yes, wait as long
+        as the policy says and return True. Returns False if the
+        error isn't retriable or we've run out of retries.
+        """
+        if not strategy:
+            strategy = self.policy.classify(error)
+        if not strategy:
+            return False
+        if self.attempt >= self.max_retries:
+            warning("Too many failures. Giving up on '%s' (%s)" % (self.label, error))
+            return False
+        if not self.policy.take():
+            warning("Retry budget exhausted. Giving up on '%s' (%s)" % (self.label, error))
+            return False
+        delay = self.policy.backoff(self.attempt, strategy)
+        self.attempt += 1
+        warning("Retrying failed request: %s (%s)" % (self.label, error))
+        if delay:
+            warning("Waiting %.1f sec..." % delay)
+            time.sleep(delay)
+        return True
+
+    def done(self):
+        self.policy.refund()
+
+# vim:et:ts=4:sts=4:ai
@@ -12,8 +12,13 @@ import mimetypes
 import re
 import Queue
 import threading
+import errno
+import socket
+import mmap
+import math
+from StringIO import StringIO
 from logging import debug, info, warning, error
-from stat import ST_SIZE
+from stat import ST_SIZE, S_ISREG
 
 try:
     from hashlib import md5
@@ -25,6 +30,14 @@ from SortedDict import SortedDict
 from BidirMap import BidirMap
 from Config import Config
 from Utils import concat_files, hash_file_md5 
+from DownloadState import DownloadState
+from Pipeline import Pipeline, response_reader, pipeline_available
+from RateLimit import BandwidthLimit, SpeedMonitor
+from Retry import RetryPolicy
+from Compress import get_codec, cpu_count, ParallelCompressor, DecompressingStream
+from Crypto import GpgEncryptor, GpgDecryptStream
+from FanOut import SharedFile
+from BufferPool import BufferPool
 from Exceptions import *
 from ACL import ACL, GranteeLogDelivery
 from AccessLog import AccessLog
@@ -84,7 +97,7 @@ class S3Request(object):
         if tmp_params != "":
             h+='?'+tmp_params[1:].encode('UTF-8')
         debug("SignHeaders: " + repr(h))
-        signature = sign_string(h)
+        signature = sign_string(h, self.s3.config.secret_key)
         self.headers["Authorization"] = "AWS "+self.s3.config.access_key+":"+signature
 
     def get_triplet(self):
@@ -94,6 +107,237 @@ class S3Request(object):
         resource['uri'] += self.format_param_str()
         return (self.method_string, resource, self.headers)
 
+class HashingStream(object):
+    """
+    Passes writes through to 'stream' and keeps the MD5 of all of them.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.md5_hash = md5()
+
+    def write(self, data):
+        self.md5_hash.update(data)
+        self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class PartStream(object):
+    """
+    Writes one range of a parallel download into 'stream' from the
+    start of part_info. The end of the range may move closer while
+    it's being received, see object_multipart_get(). Whatever goes
+    beyond it is dropped and 'monitor' is cancelled to end the request.
+    """
+    def __init__(self, stream, part_info, monitor, lock):
+        self.stream = stream
+        self.part_info = part_info
+        self.monitor = monitor
+        self.lock = lock
+        self.position = part_info['start_position']
+        stream.seek(self.position)
+
+    def write(self, data):
+        self.lock.acquire()
+        end_position = self.part_info['end_position']
+        self.lock.release()
+        data = data[:max(0, end_position - self.position + 1)]
+        self.stream.write(data)
+        self.position += len(data)
+        self.lock.acquire()
+        self.part_info['position'] = max(self.part_info['position'], self.position)
+        self.lock.release()
+        if self.position > end_position:
+            self.monitor.cancel()
+
+    def complete(self):
+        return self.position > self.part_info['end_position']
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class MemoryFile(StringIO):
+    """
+    In-memory data that send_file() can upload like a file.
+    """
+    def __init__(self, data, name):
+        StringIO.__init__(self, data)
+        self.name = name
+
+class RelayFile(object):
+    """
+    RelayFile(s3, uri, offset, length)
+
+    Read-only file over 'length' bytes of object 'uri' from 'offset'
+    on, fetched through 's3' by a ranged GET while being read, so that
+    send_file() can upload an object of another account or endpoint
+    with no local copy. Seeking anywhere but to the current position,
+    e.g. when send_file() retries, starts a new GET from there.
+    """
+    def __init__(self, s3, uri, offset, length):
+        self.s3 = s3
+        self.uri = uri
+        self.name = uri.uri()
+        self.position = offset
+        self.stop = offset + length
+        self.conn = None
+        self.response = None
+
+    def seek(self, offset):
+        if offset != self.position:
+            self.close()
+            self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size = -1):
+        if size < 0 or size > self.stop - self.position:
+            size = self.stop - self.position
+        if size <= 0:
+            return ""
+        if not self.response:
+            self.conn, self.response = self.s3.object_get_open(self.uri, self.position, self.stop - 1)
+        data = self.response.read(size)
+        if not data:
+            self.close()
+            raise IOError("%s: connection closed at %d" % (self.name, self.position))
+        self.position += len(data)
+        return data
+
+    def readinto(self, target):
+        data = self.read(len(target))
+        target[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+        self.conn = None
+        self.response = None
+
+class MultipartUpload(object):
+    """
+    MultipartUpload(s3, uri, headers, labels, threads)
+
+    Multipart upload of parts that come one after another. Up to
+    'threads' parts are sent at the same time, each retried on its
+    own, send() and send_range() wait for one of them to finish
+    before taking another. That way no more than 'threads' parts
+    are held in memory besides the one being filled.
+    """
+    def __init__(self, s3, uri, headers, labels, threads):
+        self.s3 = s3
+        self.uri = uri
+        self.labels = labels
+        request = s3.create_request("OBJECT_POST", uri = uri, headers = headers, uploads = '')
+        self.upload_id = getTextFromXml(s3.send_request(request)["data"], ".//UploadId")
+        debug("Upload ID = %s" % self.upload_id)
+        self.etags = {}
+        self.part_count = 0
+        self.size = 0
+        self.failure = None
+        self.slots = threading.Semaphore(max(1, threads))
+        self.threads = []
+
+    def send(self, data, reserved = 0):
+        """
+        Send 'data' as the next part. 'reserved' bytes of BufferPool
+        budget held for them are given back once the part is done.
+        """
+        try:
+            self._start(self._upload(lambda: MemoryFile(data, self.labels['source']), 0, len(data)), len(data), reserved)
+        except:
+            BufferPool().unreserve(reserved)
+            raise
+
+    def send_range(self, filename, offset, length):
+        """
+        Send 'length' bytes of 'filename' from 'offset' on as the
+        next part, read right from the file.
+        """
+        self._start(self._upload(lambda: open_bulk(filename), offset, length), length)
+
+    def send_file(self, file, offset, length):
+        """
+        Send 'length' bytes of the open 'file' from 'offset' on as
+        the next part. 'file' is closed when done, or right away if
+        the upload has failed already.
+        """
+        try:
+            self._start(self._upload(lambda: file, offset, length), length)
+        except:
+            file.close()
+            raise
+
+    def send_copy(self, src_uri, src_etag, offset, length):
+        """
+        Make 'length' bytes of object 'src_uri' from 'offset' on the
+        next part by UploadPartCopy, on the server side. Fails if the
+        object no longer has ETag 'src_etag'.
+        """
+        def copy(part_number):
+            return self.s3._copy_part(self.uri, self.upload_id, part_number, src_uri, src_etag, offset, length)
+        self._start(copy, length)
+
+    def _upload(self, opener, offset, length):
+        def upload(part_number):
+            file = opener()
+            try:
+                return self.s3._send_part(self.uri, self.upload_id, part_number, file, offset, length, self.labels)
+            finally:
+                file.close()
+        return upload
+
+    def _start(self, send, length, reserved = 0):
+        self.slots.acquire()
+        if self.failure:
+            self.slots.release()
+            raise self.failure
+        self.part_count += 1
+        self.size += length
+        t = threading.Thread(target = self._send_part, args = (self.part_count, send, reserved))
+        t.setDaemon(True)
+        t.start()
+        self.threads = [thread for thread in self.threads if thread.isAlive()] + [t]
+
+    def _send_part(self, part_number, send, reserved):
+        try:
+            try:
+                self.etags[part_number] = send(part_number)
+            except Exception, e:
+                self.failure = e
+        finally:
+            if reserved:
+                BufferPool().unreserve(reserved)
+            self.slots.release()
+
+    def wait(self):
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def complete(self):
+        self.wait()
+        if self.failure:
+            raise self.failure
+        body = "<CompleteMultipartUpload>\n"
+        for part_number in range(1, self.part_count + 1):
+            body += "  <Part>\n"
+            body += "   <PartNumber>%d</PartNumber>\n" % part_number
+            body += "   <ETag>%s</ETag>\n" % self.etags[part_number]
+            body += "  </Part>\n"
+        body += "</CompleteMultipartUpload>"
+        request = self.s3.create_request("OBJECT_POST", uri = self.uri, uploadId = self.upload_id)
+        response = self.s3.send_request(request, body)
+        if getRootTagName(response["data"]) != "CompleteMultipartUploadResult":
+            raise S3Error(response)
+        return response
+
+    def abort(self):
+        self.wait()
+        self.s3.abort_multipart_upload(self.uri, self.upload_id)
+
 class S3(object):
     http_methods = BidirMap(
         GET = 0x01,
@@ -143,9 +387,6 @@ class S3(object):
     ## S3 sometimes sends HTTP-307 response
     redir_map = {}
 
-    ## Maximum attempts of re-issuing failed requests
-    _max_retries = 5
-
     ##Default exit status = 0 (SUCCESS)
     exit_status = 0
 
@@ -166,7 +407,7 @@ class S3(object):
             if self.redir_map.has_key(bucket):
                 host = self.redir_map[bucket]
             else:
-                host = getHostnameFromBucket(bucket)
+                host = getHostnameFromBucket(bucket, self.config.host_bucket)
         else:
             host = self.config.host_base
         debug('get_hostname(%s): %s' % (bucket, host))
@@ -336,30 +577,44 @@ class S3(object):
 
         return response
 
-    def object_multipart_upload(self, filename, uri, cfg, extra_headers = None, extra_label = ""):
-        if uri.type != "s3":
-            raise ValueError("Expected URI type 's3', got '%s'" % uri.type)
+    def object_multipart_upload(self, filename, uri, extra_headers = None, extra_label = "", md5sum = None):
+        """
+        Upload 'filename' in parts of multipart_upload_part_size bytes,
+        or more to stay within 10000 parts, multipart_upload_threads
+        of them at a time. A failed part is sent again on its own.
+        The parts are read right from the file, with no extra memory.
+        The MD5 of the file is kept in x-amz-meta-md5sum, as the ETag
+        of the object won't tell it. Pass 'md5sum' if it's known.
+        """
+        result = self.object_multipart_upload_fanout(filename, [uri], extra_headers, extra_label, md5sum)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def object_multipart_upload_fanout(self, filename, uris, extra_headers = None, extra_label = "", md5sum = None):
+        """
+        Like object_multipart_upload() but to each of 'uris' at once.
+        Every part is read from disk only once for all of them, see
+        FanOut.SharedFile. Returns the response or the exception that
+        ended the upload for each of 'uris', in their order.
+        """
+        for uri in uris:
+            if uri.type != "s3":
+                raise ValueError("Expected URI type 's3', got '%s'" % uri.type)
 
         if not os.path.isfile(filename):
             raise InvalidFileError(u"%s is not a regular file" % unicodise(filename))
         try:
-            file = open(filename, "rb")
             file_size = os.stat(filename)[ST_SIZE]
+            if not md5sum:
+                info(u"Calculating MD5 of %s" % unicodise(filename))
+                md5sum = hash_file_md5(filename)
         except (IOError, OSError), e:
             raise InvalidFileError(u"%s: %s" % (unicodise(filename), e.strerror))
 
-        parts_size = file_size / cfg.parallel_multipart_upload_count
-        debug("File size=%d parts size=%d" %(file_size, parts_size))
-        if parts_size < 5*1024*1024:
-            warning("File part size is less than minimum required size (5 MB). Disabled parallel multipart upload")
-            return self.object_put(filename, uri, extra_headers = extra_headers, extra_label = extra_label)
-
-        md5_hash = hash_file_md5(filename)
-        info("Calculating md5sum for %s" %filename)
         headers = SortedDict(ignore_case = True)
         if extra_headers:
             headers.update(extra_headers)
-
         content_type = self.config.mime_type
         if not content_type and self.config.guess_mime_type:
             content_type = mimetypes.guess_type(filename)[0]
@@ -367,142 +622,411 @@ class S3(object):
             content_type = self.config.default_mime_type
         debug("Content-Type set to '%s'" % content_type)
         headers["content-type"] = content_type
+        headers["x-amz-meta-md5sum"] = md5sum
         if self.config.acl_public:
             headers["x-amz-acl"] = "public-read"
         if self.config.reduced_redundancy:
             headers["x-amz-storage-class"] = "REDUCED_REDUNDANCY"
 
-        headers = {}
-        headers['date'] = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
-        headers['x-amz-meta-md5sum'] = md5_hash
-        initiate_request = self.create_request("OBJECT_POST", headers = headers, uri = uri, uploads='')
-        initiate_response = self.send_request(initiate_request)
-        upload_id = getTextFromXml(initiate_response["data"], ".//UploadId")
-        #Upload single file size
-
-        debug("Upload ID = %s" %upload_id)
+        parts_size = max(self.config.multipart_upload_part_size, (file_size + 9999) / 10000, 5 * 1024 * 1024)
+        parts_count = max(1, (file_size + parts_size - 1) / parts_size)
+        debug("File size=%d parts size=%d parts count=%d" % (file_size, parts_size, parts_count))
 
-        multipart_ranges = []
-        global upload_worker_queue
-        global part_upload_list
-
-        part_upload_list = {}
-        upload_worker_queue = Queue.Queue()
-        i = 1
-        for offset in range(0, file_size, parts_size):
-            start_offset = offset 
-         
-            if start_offset + parts_size - 1 < file_size:
-                end_offset = start_offset + parts_size - 1
-                if i == cfg.parallel_multipart_upload_count:
-                    end_offset = file_size - 1
-            else:
-                end_offset = file_size - 1  
+        timestamp_start = time.time()
+        uploads = []
+        results = []
+        for uri in uris:
+            labels = { 'source' : unicodise(filename), 'destination' : unicodise(uri.uri()), 'extra' : extra_label }
+            try:
+                uploads.append(MultipartUpload(self, uri, headers, labels, self.config.multipart_upload_threads))
+                results.append(None)
+            except Exception, e:
+                uploads.append(None)
+                results.append(e)
+
+        ## A failed upload drops out, the others go on
+        def send(index, method, *args):
+            try:
+                method(*args)
+            except Exception, e:
+                results[index] = e
 
-            item = {'part_no':i, 'start_position':start_offset, 'end_position':end_offset, 'uri':uri, 'upload_id':upload_id, 'filename':filename}
+        def abort(index):
+            try:
+                uploads[index].abort()
+            except Exception, e:
+                warning(u"Aborting the upload to %s failed: %s" % (uris[index], e))
 
-            multipart_ranges.append(item)
-            upload_worker_queue.put(item)
-            debug("Part %d start=%d end=%d (part size=%d)" %(i, start_offset, end_offset, parts_size))
-            i+=1
-            if end_offset == file_size - 1:
-                break
+        try:
+            for offset in range(0, file_size, parts_size):
+                length = min(parts_size, file_size - offset)
+                active = [index for index in range(len(uris)) if results[index] is None]
+                if len(active) == 1:
+                    send(active[0], uploads[active[0]].send_range, filename, offset, length)
+                elif active:
+                    try:
+                        shared = SharedFile(filename, offset, length, self.config.fanout_buffer_size)
+                    except IOError, e:
+                        for index in active:
+                            results[index] = InvalidFileError(u"%s: %s" % (unicodise(filename), e.strerror))
+                        break
+                    views = [shared.view() for index in active]
+                    for index, view in zip(active, views):
+                        send(index, uploads[index].send_file, view, offset, length)
+            if file_size == 0:
+                for index in range(len(uris)):
+                    if results[index] is None:
+                        send(index, uploads[index].send, "")
+        except:
+            for index in range(len(uris)):
+                if uploads[index]:
+                    abort(index)
+            raise
 
-        def part_upload_worker():
-            while True:
-                try:
-                    part_info = upload_worker_queue.get_nowait()
-                except Queue.Empty:
-                    return
-                part_number = part_info['part_no']
-                start_position = part_info['start_position']
-                end_position = part_info['end_position']
-                uri = part_info['uri']
-                upload_id = part_info['upload_id']
-                filename = part_info['filename']
+        for index in range(len(uris)):
+            if not uploads[index]:
+                continue
+            if results[index] is not None:
+                abort(index)
+                continue
+            try:
+                response = uploads[index].complete()
+            except Exception, e:
+                abort(index)
+                results[index] = e
+                continue
+            debug("Upload of %d file parts to %s complete" % (parts_count, uris[index]))
+            response["elapsed"] = time.time() - timestamp_start
+            response["size"] = file_size
+            response["md5"] = md5sum
+            response["speed"] = response["elapsed"] and float(response["size"]) / response["elapsed"] or float(-1)
+            results[index] = response
+        return results
+
+    def object_put(self, filename, uri, extra_headers = None, extra_label = "", file = None):
+        # TODO TODO
+        # Make it consistent with stream-oriented object_get()
+        if uri.type != "s3":
+            raise ValueError("Expected URI type 's3', got '%s'" % uri.type)
 
-                file = open(filename, 'rb')
+        if not os.path.isfile(filename):
+            raise InvalidFileError(u"%s is not a regular file" % unicodise(filename))
+        try:
+            size = os.stat(filename)[ST_SIZE]
+            if not file:
+                if self.multipart_wanted(size):
+                    return self.object_multipart_upload(filename, uri, extra_headers, extra_label)
+                file = open_bulk(filename)
+        except (IOError, OSError), e:
+            raise InvalidFileError(u"%s: %s" % (unicodise(filename), e.strerror))
+        headers = SortedDict(ignore_case = True)
+        if extra_headers:
+            headers.update(extra_headers)
+        headers["content-length"] = size
+        content_type = self.config.mime_type
+        if not content_type and self.config.guess_mime_type:
+            content_type = mimetypes.guess_type(filename)[0]
+        if not content_type:
+            content_type = self.config.default_mime_type
+        debug("Content-Type set to '%s'" % content_type)
+        headers["content-type"] = content_type
+        if self.config.acl_public:
+            headers["x-amz-acl"] = "public-read"
+        if self.config.reduced_redundancy:
+            headers["x-amz-storage-class"] = "REDUCED_REDUNDANCY"
+        request = self.create_request("OBJECT_PUT", uri = uri, headers = headers)
+        labels = { 'source' : unicodise(filename), 'destination' : unicodise(uri.uri()), 'extra' : extra_label }
+        response = self.send_file(request, file, labels)
+        return response
 
-                headers = SortedDict(ignore_case = True)
-                #if extra_headers:
-                #    headers.update(extra_headers)
+    def multipart_wanted(self, size):
+        return self.config.multipart_upload and size >= self.config.multipart_upload_threshold or \
+               size > 5 * 1024 * 1024 * 1024
 
-                headers["content-length"] = end_position - start_position + 1
-                headers['Expect'] = '100-continue'
+    def object_put_fanout(self, filename, uris, extra_headers = None, extra_label = ""):
+        """
+        Upload 'filename' to each of 'uris' at the same time, reading
+        it from disk only once (see FanOut.SharedFile). Every upload
+        has its own connection and retries, one failing doesn't stop
+        the others. Returns the response or the exception that ended
+        the upload for each of 'uris', in their order.
+        """
+        if len(uris) == 1:
+            try:
+                return [self.object_put(filename, uris[0], extra_headers, extra_label)]
+            except (S3UploadError, S3Error), e:
+                return [e]
+        if not os.path.isfile(filename):
+            raise InvalidFileError(u"%s is not a regular file" % unicodise(filename))
+        try:
+            size = os.stat(filename)[ST_SIZE]
+            if self.multipart_wanted(size):
+                return self.object_multipart_upload_fanout(filename, uris, extra_headers, extra_label)
+            shared = SharedFile(filename, 0, size, self.config.fanout_buffer_size)
+        except (IOError, OSError), e:
+            raise InvalidFileError(u"%s: %s" % (unicodise(filename), e.strerror))
 
-                request = self.create_request("OBJECT_PUT", uri = uri, headers = headers, partNumber = part_number, uploadId = upload_id)
-                labels = { 'source' : unicodise(filename), 'destination' : unicodise(uri.uri()), 'extra' : extra_label }
+        results = [None] * len(uris)
+        def upload(index, view):
+            try:
                 try:
-                    response = self.send_file(request, file, labels, retries = self._max_retries, part_info = part_info)
-                except S3UploadError, e:
-                    self.abort_multipart_upload(uri, upload_id)
-                    file.close()
-                    raise S3UploadError("Failed to upload part-%d to S3" %part_info['part_no'])
-                part_upload_list[part_number] = response["headers"]["etag"].strip('"\'')
-                file.close()
-
-        for i in range(cfg.parallel_multipart_upload_threads):
-            t = threading.Thread(target=part_upload_worker)
+                    results[index] = self.object_put(filename, uris[index], extra_headers, extra_label, file = view)
+                except Exception, e:
+                    results[index] = e
+            finally:
+                view.close()
+
+        threads = []
+        for index in range(len(uris)):
+            t = threading.Thread(target = upload, args = (index, shared.view()))
             t.setDaemon(True)
+            threads.append(t)
+        for t in threads:
             t.start()
+        for t in threads:
+            t.join()
+        return results
 
-        timestamp_start = time.time()
-        while threading.activeCount() > 1:
-            time.sleep(0.1)
-        debug("Upload of file parts complete")
-
-        body = "<CompleteMultipartUpload>\n"
-        for part in part_upload_list.keys():
-            body += "  <Part>\n"
-            body += "   <PartNumber>%d</PartNumber>\n" %part
-            body += "   <ETag>%s</ETag>\n" %part_upload_list[part]
-            body += "  </Part>\n"
-        body += "</CompleteMultipartUpload>"
-
-        complete_request = self.create_request("OBJECT_POST", uri = uri, uploadId = upload_id)
-        response = self.send_request(complete_request, body)
-        timestamp_end = time.time()
+    def object_put_append(self, filename, uri, extra_headers = None, extra_label = ""):
+        """
+        Upload 'filename' that has grown since it was stored as 'uri'
+        by sending only what was appended. The object must be a prefix
+        of the file, checked against the MD5 of the file up to the
+        size of the object. The new object is made by a multipart
+        upload whose first parts are copied from the old one with
+        UploadPartCopy, the rest are read from the file. Returns None
+        if the object isn't a prefix or has no MD5 to tell, or is too
+        small to copy parts of, and the file has to be uploaded whole.
+        """
+        if uri.type != "s3":
+            raise ValueError("Expected URI type 's3', got '%s'" % uri.type)
+        if not os.path.isfile(filename):
+            raise InvalidFileError(u"%s is not a regular file" % unicodise(filename))
+        src_headers = self.object_info(uri)['headers']
+        if src_headers.has_key('x-amz-meta-s3cmd-md5') or src_headers.has_key('content-encoding'):
+            ## Stored encoded, the object isn't the file's bytes
+            return None
+        src_size = int(src_headers['content-length'])
+        src_etag = src_headers['etag']
+        src_md5 = src_etag.strip('"\'')
+        if src_md5.find('-') > -1:
+            src_md5 = src_headers.get('x-amz-meta-md5sum')
+        try:
+            file_size = os.stat(filename)[ST_SIZE]
+            ## Parts other than the last one must be at least 5 MB
+            if not src_md5 or src_size < 5 * 1024 * 1024 or file_size <= src_size:
+                return None
+            info(u"Calculating MD5 of %s" % unicodise(filename))
+            prefix_md5, md5sum = hash_file_md5_prefix(filename, src_size)
+        except (IOError, OSError), e:
+            raise InvalidFileError(u"%s: %s" % (unicodise(filename), e.strerror))
+        if prefix_md5 != src_md5:
+            debug(u"%s is not a prefix of %s, uploading it whole" % (uri, unicodise(filename)))
+            return None
 
-        object_info = self.object_info(uri)
-        upload_size = int(object_info['headers']['content-length'])
-        #file_md5sum = info['headers']['etag'].strip('"')
+        headers = SortedDict(ignore_case = True)
+        if extra_headers:
+            headers.update(extra_headers)
+        content_type = self.config.mime_type
+        if not content_type and self.config.guess_mime_type:
+            content_type = mimetypes.guess_type(filename)[0]
+        if not content_type:
+            content_type = src_headers.get('content-type', self.config.default_mime_type)
+        headers["content-type"] = content_type
+        headers["x-amz-meta-md5sum"] = md5sum
+        if self.config.acl_public:
+            headers["x-amz-acl"] = "public-read"
+        if self.config.reduced_redundancy:
+            headers["x-amz-storage-class"] = "REDUCED_REDUNDANCY"
 
-        response = {}
-        response["headers"] = object_info["headers"]
-        #response["md5match"] = file_md5sum.strip() == md5_hash_file.strip()
-        response["md5"] = md5_hash
-        #if not response["md5match"]:
-        #    warning("MD5 signatures do not match: computed=%s, received=%s" % (md5_hash_file, file_md5sum))
-        #    warning("Aborting file upload")
-        #    self.abort_multipart_upload(uri, upload_id)
-        #    raise S3UploadError
+        ## Copied parts of at least 5 MB and at most 5 GB each, all of
+        ## them within 10000 parts
+        copy_size = min(max(self.config.multipart_copy_part_size, src_size / 5000 + 1, 5 * 1024 * 1024),
+                        2 * 1024 * 1024 * 1024)
+        copy_count = max(1, src_size / copy_size)
+        tail_size = file_size - src_size
+        parts_size = max(self.config.multipart_upload_part_size, tail_size / (10000 - copy_count) + 1, 5 * 1024 * 1024)
+        debug("Appending %d bytes to %d bytes in %d copied parts and parts of %d bytes" % (tail_size, src_size, copy_count, parts_size))
 
-        response["elapsed"] = timestamp_end - timestamp_start
-        response["size"] = file_size
+        timestamp_start = time.time()
+        labels = { 'source' : unicodise(filename), 'destination' : unicodise(uri.uri()), 'extra' : extra_label }
+        upload = MultipartUpload(self, uri, headers, labels, self.config.multipart_upload_threads)
+        try:
+            for index in range(copy_count):
+                offset = src_size * index / copy_count
+                upload.send_copy(uri, src_etag, offset, src_size * (index + 1) / copy_count - offset)
+            for offset in range(src_size, file_size, parts_size):
+                upload.send_range(filename, offset, min(parts_size, file_size - offset))
+            response = upload.complete()
+        except:
+            upload.abort()
+            raise
+        response["elapsed"] = time.time() - timestamp_start
+        response["size"] = tail_size
+        response["md5"] = md5sum
         response["speed"] = response["elapsed"] and float(response["size"]) / response["elapsed"] or float(-1)
-        if response["size"] != upload_size:
-            warning("Reported size (%s) does not match received size (%s)" % (upload_size, response["size"]))
-            self.abort_multipart_upload()
         return response
 
+    def object_put_compressed(self, filename, uri, extra_headers = None, extra_label = ""):
+        """
+        Upload 'filename' compressed on the fly with Config.compress.
+        The original MD5 and size are kept in the metadata for 'sync'
+        and for verification after the download.
+        """
+        file, size, headers = self._prepare_stream_put(filename, extra_headers)
+        mtime = os.fstat(file.fileno()).st_mtime
+        codec = get_codec(self.config.compress, self.config.compress_level)
+        headers["content-encoding"] = codec.content_encoding
+        headers["x-amz-meta-s3cmd-compress"] = codec.name
+        compressor = ParallelCompressor(codec, self.config.compress_block_size,
+                                        self.config.compress_threads or cpu_count())
+        def chunks():
+            for data in compressor.compress(file):
+                yield data
+            ## Hashed on the way instead of reading the file twice,
+            ## object_put_stream() takes care of the late header
+            headers["x-amz-meta-s3cmd-md5"] = compressor.md5_hash.hexdigest()
+        labels = { 'source' : unicodise(filename), 'destination' : unicodise(uri.uri()), 'extra' : extra_label }
+        response = self.object_put_stream(chunks(), uri, headers, size, labels)
+        st = os.fstat(file.fileno())
+        file.close()
+        if st.st_mtime != mtime or st.st_size != size:
+            warning(u"%s changed during upload, the stored MD5 may not match" % unicodise(filename))
+        return response
 
-    def object_put(self, filename, uri, extra_headers = None, extra_label = ""):
-        # TODO TODO
-        # Make it consistent with stream-oriented object_get()
-        if uri.type != "s3":
-            raise ValueError("Expected URI type 's3', got '%s'" % uri.type)
+    def object_put_encrypted(self, filename, uri, extra_headers = None, extra_label = "", encryptor = None):
+        """
+        Upload 'filename' encrypted with gpg, streaming gpg's output
+        right to S3 instead of going through a temporary file.
+        'encryptor' may be a job of an EncryptionPool that has
+        already started on the file.
+        """
+        if not encryptor:
+            encryptor = GpgEncryptor(filename)
+        size, headers = self._prepare_encrypted_put(filename, extra_headers)
+        labels = { 'source' : unicodise(filename), 'destination' : unicodise(uri.uri()), 'extra' : extra_label }
+        return self.object_put_stream(encryptor.chunks(), uri, headers, size, labels)
 
+    def object_put_encrypted_fanout(self, filename, uris, extra_headers = None, extra_label = "", encryptor = None):
+        """
+        Like object_put_encrypted() but to each of 'uris' at once, all
+        from a single run of gpg. Up to fanout_buffer_size bytes are
+        kept for each upload falling behind. One failing doesn't stop
+        the others. Returns the response or the exception that ended
+        the upload for each of 'uris', in their order.
+        """
+        if len(uris) == 1:
+            try:
+                return [self.object_put_encrypted(filename, uris[0], extra_headers, extra_label, encryptor)]
+            except (S3UploadError, S3Error, InvalidFileError), e:
+                return [e]
+        if not encryptor:
+            encryptor = GpgEncryptor(filename)
+        size, headers = self._prepare_encrypted_put(filename, extra_headers)
+
+        queue_size = max(1, self.config.fanout_buffer_size / GpgEncryptor.chunk_size)
+        queues = [Queue.Queue(queue_size) for uri in uris]
+        detached = [False] * len(uris)
+        results = [None] * len(uris)
+        def chunks(index):
+            while True:
+                data = queues[index].get()
+                if data is None:
+                    return
+                if isinstance(data, Exception):
+                    raise data
+                yield data
+
+        def upload(index):
+            labels = { 'source' : unicodise(filename), 'destination' : unicodise(uris[index].uri()), 'extra' : extra_label }
+            try:
+                results[index] = self.object_put_stream(chunks(index), uris[index], SortedDict(headers, ignore_case = True),
+                                                        size, labels)
+            except Exception, e:
+                results[index] = e
+            ## Make sure the feeder isn't left waiting for room
+            detached[index] = True
+            while True:
+                try:
+                    queues[index].get_nowait()
+                except Queue.Empty:
+                    break
+
+        threads = []
+        for index in range(len(uris)):
+            t = threading.Thread(target = upload, args = (index,))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        end = None
+        try:
+            for data in encryptor.chunks():
+                for index in range(len(uris)):
+                    if not detached[index]:
+                        queues[index].put(data)
+        except Exception, e:
+            end = e
+        for index in range(len(uris)):
+            if not detached[index]:
+                queues[index].put(end)
+        for t in threads:
+            t.join()
+        return results
+
+    def _prepare_encrypted_put(self, filename, extra_headers):
+        file, size, headers = self._prepare_stream_put(filename, extra_headers)
+        file.close()
+        try:
+            headers["x-amz-meta-s3cmd-md5"] = hash_file_md5(filename)
+        except (IOError, OSError), e:
+            raise InvalidFileError(u"%s: %s" % (unicodise(filename), e.strerror))
+        headers["x-amz-meta-s3tools-gpgenc"] = "gpg"
+        return size, headers
+
+    def object_put_pipe(self, stream, uri, extra_headers = None, extra_label = ""):
+        """
+        Upload everything read from 'stream', e.g. stdin, until EOF.
+        """
+        headers = SortedDict(ignore_case = True)
+        if extra_headers:
+            headers.update(extra_headers)
+        headers["content-type"] = self.config.mime_type or self.config.default_mime_type
+        if self.config.acl_public:
+            headers["x-amz-acl"] = "public-read"
+        if self.config.reduced_redundancy:
+            headers["x-amz-storage-class"] = "REDUCED_REDUNDANCY"
+        md5_hash = md5()
+        def chunks():
+            while True:
+                data = stream.read(1024 * 1024)
+                if not data:
+                    break
+                md5_hash.update(data)
+                yield data
+            ## Goes out with a single PUT, or by a copy after the last part
+            headers["x-amz-meta-md5sum"] = md5_hash.hexdigest()
+        labels = { 'source' : u"<stdin>", 'destination' : unicodise(uri.uri()), 'extra' : extra_label }
+        response = self.object_put_stream(chunks(), uri, headers, -1, labels)
+        response["md5"] = md5_hash.hexdigest()
+        return response
+
+    def _prepare_stream_put(self, filename, extra_headers):
+        """
+        Open 'filename' and build the headers for uploading it in some
+        encoded form, with the size of the original file kept in
+        x-amz-meta-s3cmd-size. Its MD5 goes into x-amz-meta-s3cmd-md5,
+        which is up to the caller.
+        """
         if not os.path.isfile(filename):
             raise InvalidFileError(u"%s is not a regular file" % unicodise(filename))
         try:
-            file = open(filename, "rb")
+            file = open_bulk(filename)
             size = os.stat(filename)[ST_SIZE]
         except (IOError, OSError), e:
             raise InvalidFileError(u"%s: %s" % (unicodise(filename), e.strerror))
         headers = SortedDict(ignore_case = True)
         if extra_headers:
             headers.update(extra_headers)
-        headers["content-length"] = size
         content_type = self.config.mime_type
         if not content_type and self.config.guess_mime_type:
             content_type = mimetypes.guess_type(filename)[0]
@@ -510,15 +1034,105 @@ class S3(object):
             content_type = self.config.default_mime_type
         debug("Content-Type set to '%s'" % content_type)
         headers["content-type"] = content_type
+        headers["x-amz-meta-s3cmd-size"] = size
         if self.config.acl_public:
             headers["x-amz-acl"] = "public-read"
         if self.config.reduced_redundancy:
             headers["x-amz-storage-class"] = "REDUCED_REDUNDANCY"
-        request = self.create_request("OBJECT_PUT", uri = uri, headers = headers)
-        labels = { 'source' : unicodise(filename), 'destination' : unicodise(uri.uri()), 'extra' : extra_label }
-        response = self.send_file(request, file, labels, retries = self._max_retries)
+        return file, size, headers
+
+    def object_put_stream(self, chunks, uri, headers, size, labels):
+        """
+        Upload data of unknown length coming from the 'chunks' iterator.
+        They go out in multipart upload parts as soon as a part is full,
+        or in a single PUT if everything fits into one part, so nothing
+        is written to disk. 'size' is an estimate of the total used to
+        pick the part size, the response tells the real one. Pass -1
+        when there's no telling, e.g. for a pipe. Headers that 'chunks'
+        adds at the end still go out with a single PUT, an object that
+        went up in parts gets them by a copy onto itself afterwards.
+        """
+        if uri.type != "s3":
+            raise ValueError("Expected URI type 's3', got '%s'" % uri.type)
+        ## Stay within 10000 parts even if the data grow a bit
+        part_size = max(self.config.multipart_upload_part_size, 5 * 1024 * 1024, size / 9000 + 1)
+        timestamp_start = time.time()
+        pool = BufferPool()
+        upload = None
+        stored_size = 0
+        buffer = []
+        buffered = 0
+        try:
+            for data in chunks:
+                ## Holding off here stops 'chunks' from producing more
+                ## while the parts in flight use up the memory budget
+                pool.reserve(len(data), held = buffered)
+                buffer.append(data)
+                buffered += len(data)
+                if buffered < part_size:
+                    continue
+                if not upload:
+                    upload = MultipartUpload(self, uri, headers, labels, self.config.multipart_upload_threads)
+                    sent_headers = headers.copy()
+                reserved = buffered
+                buffered = 0
+                upload.send("".join(buffer), reserved)
+                buffer = []
+                if size < 0 and upload.part_count % 1000 == 0:
+                    ## Double the parts every 1000 so that 10000 of them
+                    ## get past the largest object S3 takes
+                    part_size *= 2
+                    debug("Part size raised to %d after %d parts" % (part_size, upload.part_count))
+            if upload:
+                if buffered:
+                    reserved = buffered
+                    buffered = 0
+                    upload.send("".join(buffer), reserved)
+                response = upload.complete()
+                stored_size = upload.size
+            else:
+                headers["content-length"] = buffered
+                request = self.create_request("OBJECT_PUT", uri = uri, headers = headers)
+                response = self.send_file(request, MemoryFile("".join(buffer), labels['source']), labels)
+                stored_size = buffered
+                pool.unreserve(buffered)
+                buffered = 0
+        except:
+            pool.unreserve(buffered)
+            if upload:
+                upload.abort()
+            raise
+        if upload and headers != sent_headers:
+            self.object_copy(uri, uri, headers, stored_size, metadata_directive = "REPLACE")
+        if size < 0:
+            size = stored_size
+        response["elapsed"] = time.time() - timestamp_start
+        response["size"] = size
+        response["stored_size"] = stored_size
+        response["speed"] = response["elapsed"] and float(response["size"]) / response["elapsed"] or float(-1)
+        debug(u"Stored %d bytes of data as %d bytes in %s" % (size, stored_size, uri))
         return response
 
+    def _send_part(self, uri, upload_id, part_number, file, offset, length, labels):
+        headers = SortedDict(ignore_case = True)
+        headers["content-length"] = length
+        request = self.create_request("OBJECT_PUT", uri = uri, headers = headers, partNumber = part_number, uploadId = upload_id)
+        response = self.send_file(request, file, labels, part_info = { 'part_no' : part_number, 'start_position' : offset })
+        return response["headers"]["etag"]
+
+    def _copy_part(self, uri, upload_id, part_number, src_uri, src_etag, offset, length):
+        headers = SortedDict(ignore_case = True)
+        headers['x-amz-copy-source'] = "/%s/%s" % (src_uri.bucket(), self.urlencode_string(src_uri.object()))
+        headers['x-amz-copy-source-range'] = "bytes=%d-%d" % (offset, offset + length - 1)
+        ## Make sure all parts come from the same version of the source
+        headers['x-amz-copy-source-if-match'] = src_etag
+        request = self.create_request("OBJECT_PUT", uri = uri, headers = headers, partNumber = part_number, uploadId = upload_id)
+        response = self.send_request(request)
+        ## Errors may come with "200 OK" too
+        if getRootTagName(response["data"]) != "CopyPartResult":
+            raise S3Error(response)
+        return getTextFromXml(response["data"], ".//ETag")
+
     def object_get(self, uri, stream, start_position = 0, extra_label = ""):
         if uri.type != "s3":
             raise ValueError("Expected URI type 's3', got '%s'" % uri.type)
@@ -527,12 +1141,158 @@ class S3(object):
         response = self.recv_file(request, stream, labels, start_position)
         return response
 
-    def object_multipart_get(self, uri, stream, cfg, start_position = 0, extra_label = ""):
+    def object_get_open(self, uri, start_position, end_position):
+        """
+        Start a GET of bytes 'start_position' to 'end_position' of
+        'uri' and return the connection and the response to read them
+        from. Makes a single attempt, retrying is up to the caller.
+        """
+        while True:
+            request = self.create_request("OBJECT_GET", uri = uri)
+            method_string, resource, headers = request.get_triplet()
+            conn = self.get_connection(resource['bucket'])
+            conn.connect()
+            conn.putrequest(method_string, self.format_uri(resource))
+            for header in headers.keys():
+                conn.putheader(header, str(headers[header]))
+            conn.putheader("Range", "bytes=%d-%d" % (start_position, end_position))
+            conn.endheaders()
+            http_response = conn.getresponse()
+            if http_response.status >= 200 and http_response.status <= 299:
+                return conn, http_response
+            response = {}
+            response["status"] = http_response.status
+            response["reason"] = http_response.reason
+            response["headers"] = convertTupleListToDict(http_response.getheaders())
+            response["data"] = http_response.read()
+            conn.close()
+            if response["status"] != 307:
+                raise S3Error(response)
+            ## RedirectPermanent
+            redir_bucket = getTextFromXml(response['data'], ".//Bucket")
+            redir_hostname = getTextFromXml(response['data'], ".//Endpoint")
+            self.set_hostname(redir_bucket, redir_hostname)
+            warning("Redirected to: %s" % (redir_hostname))
+
+    def object_relay(self, src_s3, src_uri, dst_uri, extra_headers = None, extra_label = ""):
+        """
+        Copy 'src_uri', read through 'src_s3' with credentials and
+        endpoint of its own, to 'dst_uri' where object_copy() can't
+        do it. The data stream from the GET right into the upload,
+        nothing is stored. Objects from multipart_upload_threshold
+        up are relayed in parts, multipart_upload_threads ranged
+        GETs and part uploads at a time, so memory use stays within
+        the transfer buffers of those. Metadata go along like with
+        object_copy(), 'extra_headers' are set on top.
+        """
+        if src_uri.type != "s3":
+            raise ValueError("Expected URI type 's3', got '%s'" % src_uri.type)
+        if dst_uri.type != "s3":
+            raise ValueError("Expected URI type 's3', got '%s'" % dst_uri.type)
+        src_headers = src_s3.object_info(src_uri)['headers']
+        size = int(src_headers['content-length'])
+        src_md5 = src_headers.get('etag', '').strip('"\'')
+
+        headers = SortedDict(ignore_case = True)
+        for header in src_headers.keys():
+            if header.startswith("x-amz-meta-") or header in ("content-type", "content-encoding",
+                    "content-disposition", "content-language", "cache-control", "expires"):
+                headers[header] = src_headers[header]
+        if extra_headers:
+            headers.update(extra_headers)
+        if not headers.has_key("content-type"):
+            headers["content-type"] = self.config.default_mime_type
+        if self.config.acl_public:
+            headers["x-amz-acl"] = "public-read"
+        if self.config.reduced_redundancy:
+            headers["x-amz-storage-class"] = "REDUCED_REDUNDANCY"
+
+        timestamp_start = time.time()
+        labels = { 'source' : unicodise(src_uri.uri()), 'destination' : unicodise(dst_uri.uri()), 'extra' : extra_label }
+        if not self.multipart_wanted(size):
+            headers["content-length"] = size
+            request = self.create_request("OBJECT_PUT", uri = dst_uri, headers = headers)
+            file = RelayFile(src_s3, src_uri, 0, size)
+            try:
+                response = self.send_file(request, file, labels)
+            finally:
+                file.close()
+            stored_md5 = response["headers"]["etag"].strip('"\'')
+        else:
+            ## The new parts won't match those of the source, keep its MD5
+            if src_md5.find("-") < 0 and not headers.has_key("x-amz-meta-md5sum"):
+                headers["x-amz-meta-md5sum"] = src_md5
+            parts_size = max(self.config.multipart_upload_part_size, (size + 9999) / 10000, 5 * 1024 * 1024)
+            upload = MultipartUpload(self, dst_uri, headers, labels, self.config.multipart_upload_threads)
+            try:
+                for offset in range(0, size, parts_size):
+                    length = min(parts_size, size - offset)
+                    upload.send_file(RelayFile(src_s3, src_uri, offset, length), offset, length)
+                response = upload.complete()
+            except:
+                upload.abort()
+                raise
+            stored_md5 = None
+        if stored_md5 and src_md5.find("-") < 0 and stored_md5 != src_md5:
+            warning(u"%s changed during the relay, MD5 %s doesn't match %s" % (src_uri, stored_md5, src_md5))
+        response["elapsed"] = time.time() - timestamp_start
+        response["size"] = size
+        response["speed"] = response["elapsed"] and float(response["size"]) / response["elapsed"] or float(-1)
+        return response
+
+    def object_get_range(self, uri, stream, offset, length, md5sum = None, extra_label = ""):
+        """
+        Download 'length' bytes of object 'uri' from 'offset' on and
+        verify them against 'md5sum', e.g. a file packed into an archive.
+        """
+        if uri.type != "s3":
+            raise ValueError("Expected URI type 's3', got '%s'" % uri.type)
+        stream = HashingStream(stream)
+        if length > 0:
+            request = self.create_request("OBJECT_GET", uri = uri)
+            labels = { 'source' : unicodise(uri.uri()), 'destination' : unicodise(stream.name), 'extra' : extra_label }
+            response = self.recv_file(request, stream, labels, offset, end_position = offset + length - 1)
+        else:
+            ## Empty range can't be requested
+            response = { "headers" : {}, "elapsed" : 0 }
+        response["size"] = length
+        response["speed"] = response["elapsed"] and float(length) / response["elapsed"] or float(-1)
+        response["md5"] = stream.md5_hash.hexdigest()
+        response["md5match"] = not md5sum or md5sum == response["md5"]
+        if not response["md5match"]:
+            warning("MD5 signatures do not match: computed=%s, received=%s" % (response["md5"], md5sum))
+            self.exit_status = self.error_codes["MD5_MISMATCH"]
+        return response
+
+    def parallel_get_wanted(self, size, filename):
+        """
+        Whether an object of 'size' bytes should be downloaded to
+        'filename' by object_multipart_get(). Small objects are best
+        fetched with a single GET. If 'size' is None it's not known
+        yet and object_multipart_get() will find out. Interrupted
+        parallel downloads are always resumed in parallel.
+        """
+        if not self.config.parallel_multipart_download or filename == "-":
+            return False
+        if DownloadState(filename).exists():
+            return True
+        return size is None or size >= self.config.parallel_multipart_download_threshold
+
+    def object_multipart_get(self, uri, stream, cfg, start_position = 0, extra_label = "", resume = False):
         debug("Executing multipart download")
         if uri.type != "s3":
             raise ValueError("Expected URI type 's3', got '%s'" % uri.type)
         object_info = self.object_info(uri)
         file_size = int(object_info['headers']['content-length'])
+        if object_info['headers'].has_key('x-amz-meta-s3cmd-compress') or \
+           object_info['headers'].has_key('x-amz-meta-s3tools-gpgenc') or \
+           file_size < cfg.parallel_multipart_download_threshold and not DownloadState(stream.name).exists():
+            ## Compressed or encrypted data must be decoded in order,
+            ## small objects are fetched faster in one go
+            if resume:
+                stream.seek(0)
+                stream.truncate()
+            return self.object_get(uri, stream, extra_label = extra_label)
         file_md5sum = object_info['headers']['etag'].strip('"')
         if len(file_md5sum.split('-')) == 2:
             try:
@@ -540,63 +1300,209 @@ class S3(object):
             except:
                 warning('md5sum meta information not found in multipart uploaded file')
 
-        multipart_ranges = []
-        parts_size = file_size / cfg.parallel_multipart_download_count 
-        global worker_queue
-        tmp_dir = os.path.join(os.path.dirname(stream.name),'tmps3')
-        os.makedirs(tmp_dir)
+        ## Completed ranges are recorded next to the destination file
+        ## so that an interrupted download can fetch only what's missing.
+        state = DownloadState(stream.name, object_info['headers']['etag'], file_size)
+        if resume and state.load():
+            info(u"Resuming download of %s: %d of %d bytes already done" % (stream.name, state.completed(), file_size))
+        else:
+            state.done = []
+            stream.seek(0)
+            stream.truncate()
+            state.save()
+        stream.flush()
 
+        ## Four ranges per thread leave room for balancing slow ones,
+        ## larger objects get larger ranges up to 256 MB
+        parts_size = max(cfg.parallel_multipart_download_part_size,
+                         min(file_size / (cfg.parallel_multipart_download_threads * 4), 256 * 1024 * 1024))
+        ## Idle threads split running parts down to this size
+        min_steal = 1024 * 1024
         worker_queue = Queue.Queue()
         i = 1
-        for offset in range(0, file_size, parts_size):
-            start_offset = offset 
-            if start_offset + parts_size - 1 < file_size:
-                end_offset = start_offset + parts_size - 1
-                if i == cfg.parallel_multipart_download_count:
-                    end_offset = file_size - 1
-            else:
-                end_offset = file_size - 1  
-
-            part_stream = open(os.path.join(tmp_dir, "%s.part-%d" %(os.path.basename(stream.name), i)),'wb+')
-            item = (i, start_offset, end_offset, uri, part_stream)
-
-            multipart_ranges.append(item)
-            worker_queue.put(item)
-            i+=1
-
-            if end_offset == file_size - 1:
-                break
-
+        for range_start, range_end in state.missing():
+            for start_offset in range(range_start, range_end + 1, parts_size):
+                end_offset = min(start_offset + parts_size - 1, range_end)
+                if range_end - end_offset < parts_size / 2:
+                    ## Don't leave a tiny trailing part
+                    end_offset = range_end
+                worker_queue.put({'part_no':i, 'start_position':start_offset, 'end_position':end_offset})
+                debug("Part %d start=%d end=%d" % (i, start_offset, end_offset))
+                i += 1
+                if end_offset == range_end:
+                    break
+
+        failed_parts = []
+        ## Parts being downloaded and the time per byte of finished ones.
+        ## A part may be fetched by more than one request at a time, see
+        ## hedge_parts(), each with its own SpeedMonitor in part_info['monitors'].
+        running = {}
+        durations = []
+        lock = threading.Lock()
+        next_part_no = [i]
+
+        def fetch_part(part_info, monitor):
+            start_position = part_info['start_position']
+            part_stream = PartStream(open(stream.name, "r+b"), part_info, monitor, lock)
+            request = self.create_request("OBJECT_GET", uri = uri)
+            labels = { 'source' : unicodise(uri.uri()), 'destination' : unicodise(stream.name), 'extra' : extra_label }
+            failure = None
+            try:
+                self.recv_file(request, part_stream, labels, start_position, end_position = part_info['end_position'],
+                               monitor = monitor, quiet = True)
+            except Exception, e:
+                failure = e
+            if failure and part_stream.complete():
+                ## Cut short by steal_part(), the rest is someone else's
+                failure = None
+            part_stream.close()
+
+            lock.acquire()
+            try:
+                end_position = part_info['end_position']
+                part_info['monitors'].remove(monitor)
+                if part_info['done']:
+                    ## Another request for this part was faster
+                    return
+                if failure:
+                    if part_info['monitors']:
+                        debug(u"Download of %s part-%d failed, waiting for the other request: %s" % (uri, part_info['part_no'], failure))
+                        return
+                    error(u"Download of %s part-%d failed: %s" % (uri, part_info['part_no'], failure))
+                    failed_parts.append(part_info)
+                else:
+                    part_info['done'] = True
+                    durations.append((time.time() - part_info['started']) / (end_position - start_position + 1))
+                    for other in part_info['monitors']:
+                        other.cancel()
+                del running[part_info['part_no']]
+            finally:
+                lock.release()
+            if not failure:
+                state.add(start_position, end_position)
+
+        def start_part(part_info):
+            monitor = SpeedMonitor(cfg.low_speed_limit, cfg.low_speed_time)
+            part_info['done'] = False
+            part_info['hedged'] = False
+            part_info['monitors'] = [monitor]
+            part_info['started'] = time.time()
+            part_info['position'] = part_info['start_position']
+            running[part_info['part_no']] = part_info
+            return monitor
+
+        def steal_part():
+            """
+            Split the running part with most bytes left, the one
+            that's hedged excepted, and return its second half as
+            a new part. The request for the first half will stop
+            at the new end. Returns None if there's nothing worth
+            splitting left.
+            """
+            lock.acquire()
+            try:
+                victim = None
+                for part_info in running.values():
+                    if part_info['done'] or len(part_info['monitors']) != 1:
+                        continue
+                    left = part_info['end_position'] - part_info['position'] + 1
+                    if left >= 2 * min_steal and (not victim or left > victim_left):
+                        victim = part_info
+                        victim_left = left
+                if not victim:
+                    return None, None
+                split = victim['position'] + victim_left / 2
+                part_info = {'part_no':next_part_no[0], 'start_position':split, 'end_position':victim['end_position']}
+                next_part_no[0] += 1
+                victim['end_position'] = split - 1
+                debug("Part %d start=%d end=%d (taken over from part %d)" % (part_info['part_no'], split, part_info['end_position'], victim['part_no']))
+                return part_info, start_part(part_info)
+            finally:
+                lock.release()
 
         def get_worker():
             while True:
                 try:
-                    item = worker_queue.get_nowait()
+                    part_info = worker_queue.get_nowait()
+                    lock.acquire()
+                    monitor = start_part(part_info)
+                    lock.release()
                 except Queue.Empty:
-                    return
-                offset = item[0]
-                start_position = item[1]
-                end_position = item[2]
-                uri = item[3]
-                stream = item[4]
-                request = self.create_request("OBJECT_GET", uri = uri)
-                labels = { 'source' : unicodise(uri.uri()), 'destination' : unicodise(stream.name), 'extra' : extra_label }
-                self.recv_file(request, stream, labels, start_position, retries = self._max_retries, end_position = end_position)
-
+                    ## Nothing left to start, help with the running parts
+                    part_info, monitor = steal_part()
+                    if not part_info:
+                        return
+                fetch_part(part_info, monitor)
+
+        def hedge_parts():
+            """
+            Once there's nothing left in the queue, request again every
+            part that has been running longer than 95% of the finished
+            ones took (per byte). Whichever request finishes first wins.
+            """
+            hedges = []
+            lock.acquire()
+            try:
+                if len(durations) < 2:
+                    return hedges
+                durations.sort()
+                p95 = durations[int(math.ceil(len(durations) * 0.95)) - 1]
+                now = time.time()
+                for part_info in running.values():
+                    elapsed = now - part_info['started']
+                    ## Not worth it for parts that take less than a second
+                    if part_info['hedged'] or elapsed < 1:
+                        continue
+                    if elapsed > p95 * (part_info['end_position'] - part_info['start_position'] + 1):
+                        part_info['hedged'] = True
+                        monitor = SpeedMonitor(cfg.low_speed_limit, cfg.low_speed_time)
+                        part_info['monitors'].append(monitor)
+                        hedges.append((part_info, monitor))
+            finally:
+                lock.release()
+            return hedges
+
+        threads = []
         for i in range(cfg.parallel_multipart_download_threads):
             t = threading.Thread(target=get_worker)
             t.setDaemon(True)
             t.start()
+            threads.append(t)
+
+        ## One progress meter for all the parts
+        progress = None
+        if cfg.progress_meter:
+            labels = { 'source' : unicodise(uri.uri()), 'destination' : unicodise(stream.name), 'extra' : extra_label }
+            progress = cfg.progress_class(labels, file_size)
+            progress.initial_position = state.completed()
 
         timestamp_start = time.time()
-        while threading.activeCount() > 1:
+        while [t for t in threads if t.isAlive()]:
             time.sleep(0.1)
+            if progress:
+                progress.update(current_position = state.completed())
+            if not cfg.parallel_multipart_download_hedge or not worker_queue.empty():
+                continue
+            for part_info, monitor in hedge_parts():
+                info(u"Download of %s part-%d is slow, requesting it again" % (uri, part_info['part_no']))
+                t = threading.Thread(target=fetch_part, args=(part_info, monitor))
+                t.setDaemon(True)
+                t.start()
+                threads.append(t)
         debug("Download of file parts complete")
-        source_streams = map(lambda x: x[4], multipart_ranges)
-        md5_hash_download, download_size = concat_files(stream, True, *source_streams)
+
+        if failed_parts or state.missing():
+            if progress:
+                progress.done("failed")
+            raise S3DownloadError("Download of %d parts failed for: %s (run again to resume)" % (len(failed_parts), uri))
+        if progress:
+            progress.update(current_position = file_size)
+            progress.done("done")
+
+        md5_hash_download = hash_file_md5(stream.name)
+        download_size = os.stat(stream.name)[ST_SIZE]
         timestamp_end = time.time()
-        os.rmdir(tmp_dir)
-        stream.flush()
+        state.remove()
 
         debug("ReceivedFile: Computed MD5 = %s" % md5_hash_download)
         response = {}
@@ -622,29 +1528,145 @@ class S3(object):
         response = self.send_request(request)
         return response
 
-    def object_copy(self, src_uri, dst_uri, extra_headers = None):
+    def object_copy(self, src_uri, dst_uri, extra_headers = None, src_size = None, metadata_directive = "COPY"):
+        """
+        Server-side copy. With metadata_directive="COPY" the metadata
+        of 'src_uri' are copied as well and 'extra_headers' are ignored,
+        with "REPLACE" they are set from 'extra_headers' like by a PUT.
+        """
         if src_uri.type != "s3":
             raise ValueError("Expected URI type 's3', got '%s'" % src_uri.type)
         if dst_uri.type != "s3":
             raise ValueError("Expected URI type 's3', got '%s'" % dst_uri.type)
         headers = SortedDict(ignore_case = True)
+        if metadata_directive == "REPLACE":
+            if extra_headers:
+                headers.update(extra_headers)
+            if not headers.has_key("content-type"):
+                content_type = self.config.mime_type
+                if not content_type and self.config.guess_mime_type:
+                    content_type = mimetypes.guess_type(dst_uri.object())[0]
+                if not content_type:
+                    content_type = self.config.default_mime_type
+                headers["content-type"] = content_type
+        if src_size is None:
+            src_size = int(self.object_info(src_uri)['headers']['content-length'])
+        ## Single PUT copy is limited to 5 GB
+        if src_size >= self.config.multipart_copy_threshold or src_size > 5 * 1024 * 1024 * 1024:
+            return self.object_multipart_copy(src_uri, dst_uri, headers, metadata_directive)
         headers['x-amz-copy-source'] = "/%s/%s" % (src_uri.bucket(), self.urlencode_string(src_uri.object()))
-        ## TODO: For now COPY, later maybe add a switch?
-        headers['x-amz-metadata-directive'] = "COPY"
+        headers['x-amz-metadata-directive'] = metadata_directive
         if self.config.acl_public:
             headers["x-amz-acl"] = "public-read"
         if self.config.reduced_redundancy:
             headers["x-amz-storage-class"] = "REDUCED_REDUNDANCY"
-        # if extra_headers:
-        #   headers.update(extra_headers)
         request = self.create_request("OBJECT_PUT", uri = dst_uri, headers = headers)
         response = self.send_request(request)
         return response
 
-    def object_move(self, src_uri, dst_uri, extra_headers = None):
-        response_copy = self.object_copy(src_uri, dst_uri, extra_headers)
+    def object_multipart_copy(self, src_uri, dst_uri, extra_headers = None, metadata_directive = "COPY"):
+        """
+        Server-side copy of a large object with parallel UploadPartCopy
+        requests. Works for objects over 5 GB and is a lot faster than
+        a single copy request for big ones. Metadata are copied over
+        or replaced by 'extra_headers' as in object_copy().
+        """
+        debug("Executing multipart copy")
+        src_info = self.object_info(src_uri)
+        src_headers = src_info['headers']
+        file_size = int(src_headers['content-length'])
+        src_etag = src_headers['etag']
+
+        headers = SortedDict(ignore_case = True)
+        if metadata_directive == "REPLACE":
+            if extra_headers:
+                headers.update(extra_headers)
+        else:
+            for header in src_headers.keys():
+                if header.startswith("x-amz-meta-") or header in ("content-type", "content-encoding",
+                        "content-disposition", "content-language", "cache-control", "expires"):
+                    headers[header] = src_headers[header]
+        if not headers.has_key("x-amz-meta-md5sum"):
+            ## The copy will have a multipart ETag, keep the MD5 for downloads
+            if len(src_etag.split('-')) == 1:
+                headers["x-amz-meta-md5sum"] = src_etag.strip('"\'')
+            elif src_headers.has_key("x-amz-meta-md5sum"):
+                headers["x-amz-meta-md5sum"] = src_headers["x-amz-meta-md5sum"]
+        if self.config.acl_public:
+            headers["x-amz-acl"] = "public-read"
+        if self.config.reduced_redundancy:
+            headers["x-amz-storage-class"] = "REDUCED_REDUNDANCY"
+        initiate_request = self.create_request("OBJECT_POST", uri = dst_uri, headers = headers, uploads = '')
+        initiate_response = self.send_request(initiate_request)
+        upload_id = getTextFromXml(initiate_response["data"], ".//UploadId")
+        debug("Upload ID = %s" % upload_id)
+
+        ## At most 10000 parts of at least 5 MB each
+        parts_size = max(self.config.multipart_copy_part_size, (file_size + 9999) / 10000, 5 * 1024 * 1024)
+        worker_queue = Queue.Queue()
+        i = 1
+        for start_offset in range(0, file_size, parts_size):
+            end_offset = min(start_offset + parts_size, file_size) - 1
+            worker_queue.put({'part_no':i, 'start_position':start_offset, 'end_position':end_offset})
+            debug("Part %d start=%d end=%d" % (i, start_offset, end_offset))
+            i += 1
+        parts_count = i - 1
+
+        part_etags = {}
+        failures = []
+        def copy_worker():
+            while not failures:
+                try:
+                    part_info = worker_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    etag = self._copy_part(dst_uri, upload_id, part_info['part_no'], src_uri, src_etag,
+                                           part_info['start_position'],
+                                           part_info['end_position'] - part_info['start_position'] + 1)
+                except Exception, e:
+                    error(u"Copy of %s part-%d failed: %s" % (src_uri, part_info['part_no'], e))
+                    failures.append(e)
+                    return
+                part_etags[part_info['part_no']] = etag
+                info(u"Copied part %d of %d of %s" % (part_info['part_no'], parts_count, src_uri))
+
+        threads = []
+        for i in range(min(self.config.multipart_copy_threads, parts_count)):
+            t = threading.Thread(target=copy_worker)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+
+        timestamp_start = time.time()
+        while [t for t in threads if t.isAlive()]:
+            time.sleep(0.1)
+        debug("Copy of object parts complete")
+
+        if failures:
+            self.abort_multipart_upload(dst_uri, upload_id)
+            raise failures[0]
+
+        body = "<CompleteMultipartUpload>\n"
+        for part_number in sorted(part_etags.keys()):
+            body += "  <Part>\n"
+            body += "   <PartNumber>%d</PartNumber>\n" % part_number
+            body += "   <ETag>%s</ETag>\n" % part_etags[part_number]
+            body += "  </Part>\n"
+        body += "</CompleteMultipartUpload>"
+        complete_request = self.create_request("OBJECT_POST", uri = dst_uri, uploadId = upload_id)
+        response = self.send_request(complete_request, body)
+        if getRootTagName(response["data"]) != "CompleteMultipartUploadResult":
+            raise S3Error(response)
+        response["elapsed"] = time.time() - timestamp_start
+        response["size"] = file_size
+        response["speed"] = response["elapsed"] and float(response["size"]) / response["elapsed"] or float(-1)
+        return response
+
+    def object_move(self, src_uri, dst_uri, extra_headers = None, src_size = None):
+        response_copy = self.object_copy(src_uri, dst_uri, extra_headers, src_size)
         debug("Object %s copied to %s" % (src_uri, dst_uri))
-        if getRootTagName(response_copy["data"]) == "CopyObjectResult":
+        if getRootTagName(response_copy["data"]) in ("CopyObjectResult", "CompleteMultipartUploadResult"):
             response_delete = self.object_delete(src_uri)
             debug("Object %s deleted" % src_uri)
         return response_copy
@@ -787,62 +1809,51 @@ class S3(object):
         debug("Request: headers="+str(headers))
         return request
 
-    def _fail_wait(self, retries):
-        # Wait a few seconds. The more it fails the more we wait.
-        return (self._max_retries - retries + 1) * 3
-
-    def send_request(self, request, body = None, retries = _max_retries):
-        method_string, resource, headers = request.get_triplet()
+    def send_request(self, request, body = None, retries = None):
         debug("Processing request, please wait...")
-        if not headers.has_key('content-length'):
-            headers['content-length'] = body and len(body) or 0
-        try:
+        retry = RetryPolicy().begin(request.resource['uri'] + request.format_param_str(), retries)
+        while True:
+            ## Dated and signed anew for each attempt, retries after a
+            ## while would be refused as expired otherwise
+            method_string, resource, headers = request.get_triplet()
+            if not headers.has_key('content-length'):
+                headers['content-length'] = body and len(body) or 0
             # "Stringify" all headers
             for header in headers.keys():
                 headers[header] = str(headers[header])
-            conn = self.get_connection(resource['bucket'])
-            debug("Sending Request: method:%s body: %s uri: %s headers:%s" %(method_string,body,self.format_uri(resource),str(headers)))
-            conn.request(method_string, self.format_uri(resource), body, headers)
-            response = {}
-            http_response = conn.getresponse()
-            response["status"] = http_response.status
-            response["reason"] = http_response.reason
-            response["headers"] = convertTupleListToDict(http_response.getheaders())
-            response["data"] =  http_response.read()
-            debug("Response: " + str(response))
-            conn.close()
-        except Exception, e:
-            if retries:
-                warning("Retrying failed request: %s (%s)" % (resource['uri'], e))
-                warning("Waiting %d sec..." % self._fail_wait(retries))
-                time.sleep(self._fail_wait(retries))
-                return self.send_request(request, body, retries - 1)
-            else:
+            try:
+                conn = self.get_connection(resource['bucket'])
+                debug("Sending Request: method:%s body: %s uri: %s headers:%s" %(method_string,body,self.format_uri(resource),str(headers)))
+                conn.request(method_string, self.format_uri(resource), body, headers)
+                response = {}
+                http_response = conn.getresponse()
+                response["status"] = http_response.status
+                response["reason"] = http_response.reason
+                response["headers"] = convertTupleListToDict(http_response.getheaders())
+                response["data"] =  http_response.read()
+                debug("Response: " + str(response))
+                conn.close()
+            except (socket.error, httplib.HTTPException), e:
+                if retry.again(e):
+                    continue
                 raise S3RequestError("Request failed for: %s" % resource['uri'])
 
-        if response["status"] == 307:
-            ## RedirectPermanent
-            redir_bucket = getTextFromXml(response['data'], ".//Bucket")
-            redir_hostname = getTextFromXml(response['data'], ".//Endpoint")
-            self.set_hostname(redir_bucket, redir_hostname)
-            warning("Redirected to: %s" % (redir_hostname))
-            return self.send_request(request, body)
-
-        if response["status"] >= 500:
-            e = S3Error(response)
-            if retries:
-                warning(u"Retrying failed request: %s" % resource['uri'])
-                warning(unicode(e))
-                warning("Waiting %d sec..." % self._fail_wait(retries))
-                time.sleep(self._fail_wait(retries))
-                return self.send_request(request, body, retries - 1)
-            else:
+            if response["status"] == 307:
+                ## RedirectPermanent
+                redir_bucket = getTextFromXml(response['data'], ".//Bucket")
+                redir_hostname = getTextFromXml(response['data'], ".//Endpoint")
+                self.set_hostname(redir_bucket, redir_hostname)
+                warning("Redirected to: %s" % (redir_hostname))
+                continue
+
+            if response["status"] < 200 or response["status"] > 299:
+                e = S3Error(response)
+                if retry.again(e):
+                    continue
                 raise e
 
-        if response["status"] < 200 or response["status"] > 299:
-            raise S3Error(response)
-
-        return response
+            retry.done()
+            return response
 
     def abort_multipart_upload(self, uri, upload_id):
         headers = {}
@@ -852,247 +1863,406 @@ class S3(object):
         self.exit_status = self.error_codes["UPLOAD_ABORT"]
         return response 
 
-    def send_file(self, request, file, labels, throttle = 0, retries = _max_retries, part_info = None):
-        method_string, resource, headers = request.get_triplet()
-        size_left = size_total = headers.get("content-length")
-        if self.config.progress_meter:
-            progress = self.config.progress_class(labels, size_total)
+    def send_file(self, request, file, labels, throttle = 0, retries = None, part_info = None):
+        size_total = request.headers.get("content-length")
+        if part_info:
+            offset = part_info['start_position']
         else:
-            if part_info:
-                info("Sending file '%s' part-%d, please wait..." % (file.name, part_info['part_no']))
+            offset = 0
+        monitor = SpeedMonitor(self.config.low_speed_limit, self.config.low_speed_time)
+        retry = RetryPolicy().begin(request.resource['uri'] + request.format_param_str(), retries)
+        while True:
+            ## Dated and signed anew for each attempt, see send_request()
+            method_string, resource, headers = request.get_triplet()
+            size_left = size_total
+            progress = None
+            if self.config.progress_meter:
+                progress = self.config.progress_class(labels, size_total)
             else:
-                info("Sending file '%s', please wait..." % file.name)
+                if part_info:
+                    info("Sending file '%s' part-%d, please wait..." % (file.name, part_info['part_no']))
+                else:
+                    info("Sending file '%s', please wait..." % file.name)
 
-        timestamp_start = time.time()
-        try:
-            conn = self.get_connection(resource['bucket'])
-            conn.connect()
-            conn.putrequest(method_string, self.format_uri(resource))
-            for header in headers.keys():
-                conn.putheader(header, str(headers[header]))
-            conn.endheaders()
-        except Exception, e:
-            if self.config.progress_meter:
-                progress.done("failed")
-            if retries:
-                warning("Retrying failed request: %s (%s)" % (resource['uri'], e))
-                warning("Waiting %d sec..." % self._fail_wait(retries))
-                time.sleep(self._fail_wait(retries))
+            timestamp_start = time.time()
+            try:
+                conn = self.get_connection(resource['bucket'])
+                conn.connect()
+                monitor.start(conn)
+                conn.putrequest(method_string, self.format_uri(resource))
+                for header in headers.keys():
+                    conn.putheader(header, str(headers[header]))
+                conn.endheaders()
+            except Exception, e:
+                if self.config.progress_meter:
+                    progress.done("failed")
                 # Connection error -> same throttle value
-                return self.send_file(request, file, labels, throttle, retries - 1, part_info)
-            else:
+                if retry.again(e):
+                    continue
                 self.exit_status = self.error_codes["RETRIES_EXCEEDED"]
                 raise S3UploadError("Upload failed for: %s" % resource['uri'])
 
-        if part_info:
-            file.seek(part_info['start_position'])
-        else:
-            file.seek(0)
+            file.seek(offset)
 
-        md5_hash = md5()
-        try:
-            while (size_left > 0):
-                #debug("SendFile: Reading up to %d bytes from '%s'" % (self.config.send_chunk, file.name))
-                if size_left < self.config.send_chunk:
-                    chunk_size = size_left
-                else:
-                    chunk_size = self.config.send_chunk
-                data = file.read(chunk_size)
-                md5_hash.update(data)
-                conn.send(data)
+            md5_hash = md5()
+            limiter = BandwidthLimit().upload()
+            dropper = None
+            if self.config.cache_neutral:
+                dropper = CacheDropper(file, offset)
+            try:
+                if not throttle and self.can_sendfile(conn, file):
+                    sent = self.send_file_sendfile(conn, file, offset, size_left, md5_hash, progress, limiter, monitor, dropper)
+                    size_left -= sent
+                    file.seek(offset + sent)
+                if not throttle and isinstance(file, MemoryFile) and size_left > 0:
+                    ## Already in memory, no point in copying it through more buffers
+                    sent = self.send_file_memory(conn, file, offset, size_left, md5_hash, progress, limiter, monitor)
+                    size_left -= sent
+                if not throttle and pipeline_available and size_left > 0 and hasattr(file, "readinto"):
+                    read_into = file.readinto
+                    if dropper:
+                        def read_into(view):
+                            nbytes = file.readinto(view)
+                            dropper.update()
+                            return nbytes
+                    pipeline = Pipeline(read_into, conn.send, self.config.send_chunk,
+                                        self.config.transfer_buffer_size, self.config.transfer_buffers, limiter, monitor)
+                    sent = pipeline.run(size_left, md5_hash, progress)
+                    if sent < size_left:
+                        raise IOError("%s: unexpected end of file after %d bytes" % (file.name, size_total - size_left + sent))
+                    size_left -= sent
+                while (size_left > 0):
+                    #debug("SendFile: Reading up to %d bytes from '%s'" % (self.config.send_chunk, file.name))
+                    if size_left < self.config.send_chunk:
+                        chunk_size = size_left
+                    else:
+                        chunk_size = self.config.send_chunk
+                    data = file.read(chunk_size)
+                    if not data:
+                        raise IOError("%s: unexpected end of file after %d bytes" % (file.name, size_total - size_left))
+                    if dropper:
+                        dropper.update()
+                    md5_hash.update(data)
+                    limiter.consume(len(data))
+                    conn.send(data)
+                    monitor.update(len(data))
+                    if self.config.progress_meter:
+                        progress.update(delta_position = len(data))
+                    size_left -= len(data)
+                    if throttle:
+                        time.sleep(throttle)
+                if dropper:
+                    dropper.finish()
+                md5_computed = md5_hash.hexdigest()
+                response = {}
+                http_response = conn.getresponse()
+                response["status"] = http_response.status
+                response["reason"] = http_response.reason
+                response["headers"] = convertTupleListToDict(http_response.getheaders())
+                response["data"] = http_response.read()
+                response["size"] = size_total
+                conn.close()
+                debug(u"Response: %s" % response)
+            except Exception, e:
                 if self.config.progress_meter:
-                    progress.update(delta_position = len(data))
-                size_left -= len(data)
-                if throttle:
-                    time.sleep(throttle)
-            md5_computed = md5_hash.hexdigest()
-            response = {}
-            http_response = conn.getresponse()
-            response["status"] = http_response.status
-            response["reason"] = http_response.reason
-            response["headers"] = convertTupleListToDict(http_response.getheaders())
-            response["data"] = http_response.read()
-            response["size"] = size_total
-            conn.close()
-            debug(u"Response: %s" % response)
-        except Exception, e:
-            if self.config.progress_meter:
-                progress.done("failed")
-            debug("Retries:"+str(retries))
-            if retries:
-                if retries < self._max_retries:
-                    throttle = throttle and throttle * 5 or 0.01
-                warning("Upload failed: %s (%s)" % (resource['uri'], e))
-                warning("Retrying on lower speed (throttle=%0.2f)" % throttle)
-                warning("Waiting %d sec..." % self._fail_wait(retries))
-                time.sleep(self._fail_wait(retries))
-                # Connection error -> same throttle value
-                return self.send_file(request, file, labels, throttle, retries - 1, part_info)
-            else:
+                    progress.done("failed")
+                debug("Retries: %d" % retry.attempt)
+                if retry.again(e):
+                    if retry.attempt > 1:
+                        throttle = throttle and throttle * 5 or 0.01
+                        warning("Retrying on lower speed (throttle=%0.2f)" % throttle)
+                    continue
                 debug("Giving up on '%s' %s" % (file.name, e))
                 self.exit_status = self.error_codes["RETRIES_EXCEEDED"]
                 raise S3UploadError("Upload failed for: %s" % resource['uri'])
 
-        timestamp_end = time.time()
-        response["elapsed"] = timestamp_end - timestamp_start
-        response["speed"] = response["elapsed"] and float(response["size"]) / response["elapsed"] or float(-1)
+            timestamp_end = time.time()
+            response["elapsed"] = timestamp_end - timestamp_start
+            response["speed"] = response["elapsed"] and float(response["size"]) / response["elapsed"] or float(-1)
 
-        if self.config.progress_meter:
-            ## The above conn.close() takes some time -> update() progress meter
-            ## to correct the average speed. Otherwise people will complain that
-            ## 'progress' and response["speed"] are inconsistent ;-)
-            progress.update()
-            progress.done("done")
-
-        if response["status"] == 307:
-            ## RedirectPermanent
-            redir_bucket = getTextFromXml(response['data'], ".//Bucket")
-            redir_hostname = getTextFromXml(response['data'], ".//Endpoint")
-            self.set_hostname(redir_bucket, redir_hostname)
-            warning("Redirected to: %s" % (redir_hostname))
-            return self.send_file(request, file, labels, retries, part_info)
-
-        # S3 from time to time doesn't send ETag back in a response :-(
-        # Force re-upload here.
-        if not response['headers'].has_key('etag'):
-            response['headers']['etag'] = ''
-
-        if response["status"] < 200 or response["status"] > 299:
-            try_retry = False
-            if response["status"] >= 500:
-                ## AWS internal error - retry
-                try_retry = True
-            elif response["status"] >= 400:
+            if self.config.progress_meter:
+                ## The above conn.close() takes some time -> update() progress meter
+                ## to correct the average speed. Otherwise people will complain that
+                ## 'progress' and response["speed"] are inconsistent ;-)
+                progress.update()
+                progress.done("done")
+
+            if response["status"] == 307:
+                ## RedirectPermanent
+                redir_bucket = getTextFromXml(response['data'], ".//Bucket")
+                redir_hostname = getTextFromXml(response['data'], ".//Endpoint")
+                self.set_hostname(redir_bucket, redir_hostname)
+                warning("Redirected to: %s" % (redir_hostname))
+                continue
+
+            # S3 from time to time doesn't send ETag back in a response :-(
+            # Force re-upload here.
+            if not response['headers'].has_key('etag'):
+                response['headers']['etag'] = ''
+
+            if response["status"] < 200 or response["status"] > 299:
                 err = S3Error(response)
-                ## Retriable client error?
-                if err.code in [ 'BadDigest', 'OperationAborted', 'TokenRefreshRequired', 'RequestTimeout' ]:
-                    try_retry = True
-
-            if try_retry:
-                if retries:
-                    warning("Upload failed: %s (%s)" % (resource['uri'], S3Error(response)))
-                    warning("Waiting %d sec..." % self._fail_wait(retries))
-                    time.sleep(self._fail_wait(retries))
-                    return self.send_file(request, file, labels, throttle, retries - 1, part_info)
-                else:
-                    warning("Too many failures. Giving up on '%s'" % (file.name))
+                if retry.again(err):
+                    continue
+                if retry.policy.classify(err):
                     self.exit_status = self.error_codes["RETRIES_EXCEEDED"]
-                    raise S3UploadError
-
-            ## Non-recoverable error
-            raise S3Error(response)
+                    raise S3UploadError("Upload failed for: %s" % resource['uri'])
+                ## Non-recoverable error
+                raise err
 
-        debug("MD5 sums: computed=%s, received=%s" % (md5_computed, response["headers"]["etag"]))
-        if response["headers"]["etag"].strip('"\'') != md5_hash.hexdigest():
-            warning("MD5 Sums don't match!")
-            self.exit_status = self.error_codes["MD5_MISMATCH"]
-            if retries:
-                warning("Retrying upload of %s" % (file.name))
-                return self.send_file(request, file, labels, throttle, retries - 1, part_info)
-            else:
-                warning("Too many failures. Giving up on '%s'" % (file.name))
+            debug("MD5 sums: computed=%s, received=%s" % (md5_computed, response["headers"]["etag"]))
+            if response["headers"]["etag"].strip('"\'') != md5_computed:
+                warning("MD5 Sums don't match!")
+                self.exit_status = self.error_codes["MD5_MISMATCH"]
+                if retry.again("MD5 Sums don't match", "digest"):
+                    continue
                 self.exit_status = self.error_codes["RETRIES_EXCEEDED"]
-                raise S3UploadError
+                raise S3UploadError("Upload failed for: %s" % resource['uri'])
 
-        return response
+            retry.done()
+            return response
 
-    def recv_file(self, request, stream, labels, start_position = 0, retries = _max_retries, end_position = -1):
-        method_string, resource, headers = request.get_triplet()
-        if self.config.progress_meter:
-            progress = self.config.progress_class(labels, 0)
-        else:
-            info("Receiving file '%s', please wait..." % stream.name)
-        stream.seek(0)
-        timestamp_start = time.time()
+    def can_sendfile(self, conn, file):
+        if not self.config.use_sendfile or isinstance(conn, httplib.HTTPSConnection):
+            return False
         try:
-            conn = self.get_connection(resource['bucket'])
-            conn.connect()
-            conn.putrequest(method_string, self.format_uri(resource))
-            for header in headers.keys():
-                conn.putheader(header, str(headers[header]))
-            if start_position > 0 and end_position == -1:
-                debug("Requesting Range: %d .. end" % start_position)
-                conn.putheader("Range", "bytes=%d-" % start_position)
-            elif end_position != -1:
-                debug("Requesting Range: %d .. %d" % (start_position, end_position))
-                conn.putheader("Range", "bytes=%d-%d" % (start_position, end_position))
-            conn.endheaders()
-            response = {}
-            http_response = conn.getresponse()
-            response["status"] = http_response.status
-            response["reason"] = http_response.reason
-            response["headers"] = convertTupleListToDict(http_response.getheaders())
-            debug("Response: %s" % response)
-        except Exception, e:
-            if self.config.progress_meter:
-                progress.done("failed")
-            if retries:
-                warning("Retrying failed request: %s (%s)" % (resource['uri'], e))
-                warning("Waiting %d sec..." % self._fail_wait(retries))
-                time.sleep(self._fail_wait(retries))
-                # Connection error -> same throttle value
-                return self.recv_file(request, stream, labels, start_position, retries - 1, end_position)
+            return S_ISREG(os.fstat(file.fileno()).st_mode)
+        except (AttributeError, OSError):
+            return False
+
+    def send_file_sendfile(self, conn, file, offset, size, md5_hash, progress = None, limiter = None, monitor = None, dropper = None):
+        """
+        Zero-copy upload of 'size' bytes of 'file' from 'offset' over
+        a plain HTTP connection. The data never enter user space,
+        MD5 is computed from a read-only mmap() of the range sent.
+        'dropper' (Utils.CacheDropper) is told about each chunk sent.
+
+        Returns the number of bytes sent, which is less than 'size'
+        when sendfile() is unavailable for this file or socket and
+        the caller has to send the rest the usual way.
+        """
+        sent_total = 0
+        while sent_total < size:
+            position = offset + sent_total
+            this_chunk = min(self.config.sendfile_chunk, size - sent_total)
+            if limiter:
+                this_chunk = limiter.chunk_size(this_chunk)
+                limiter.consume(this_chunk)
+            sent = 0
+            while sent < this_chunk:
+                try:
+                    nbytes = sendfile(conn.sock, file, position + sent, this_chunk - sent)
+                except OSError, e:
+                    if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    debug("sendfile() not available: %s" % e)
+                    self.config.use_sendfile = False
+                    break
+                if not nbytes:
+                    ## The file has shrunk since the upload started
+                    raise IOError("%s: unexpected end of file after %d bytes" % (file.name, position + sent))
+                sent += nbytes
+            if sent:
+                map_offset = position - position % mmap.ALLOCATIONGRANULARITY
+                data_map = mmap.mmap(file.fileno(), position + sent - map_offset, access = mmap.ACCESS_READ, offset = map_offset)
+                md5_hash.update(buffer(data_map, position - map_offset, sent))
+                data_map.close()
+                if progress:
+                    progress.update(delta_position = sent)
+                if monitor:
+                    monitor.update(sent)
+                if dropper:
+                    dropper.update(position + sent)
+            sent_total += sent
+            if sent < this_chunk:
+                break
+        return sent_total
+
+    def send_file_memory(self, conn, file, offset, size, md5_hash, progress = None, limiter = None, monitor = None):
+        """
+        Upload 'size' bytes of MemoryFile 'file' from 'offset' on right
+        out of its data, in chunks of up to Config.transfer_buffer_size.
+        Returns the number of bytes sent.
+        """
+        data = file.getvalue()
+        stop = min(len(data), offset + size)
+        position = offset
+        while position < stop:
+            this_chunk = min(self.config.transfer_buffer_size, stop - position)
+            if limiter:
+                this_chunk = limiter.chunk_size(this_chunk)
+                limiter.consume(this_chunk)
+            chunk = buffer(data, position, this_chunk)
+            md5_hash.update(chunk)
+            conn.send(chunk)
+            if progress:
+                progress.update(delta_position = this_chunk)
+            if monitor:
+                monitor.update(this_chunk)
+            position += this_chunk
+        file.seek(position)
+        return position - offset
+
+    def recv_file(self, request, stream, labels, start_position = 0, retries = None, end_position = -1, monitor = None, quiet = False):
+        ## Parts of a parallel download share one progress meter
+        show_progress = self.config.progress_meter and not quiet
+        if not monitor:
+            monitor = SpeedMonitor(self.config.low_speed_limit, self.config.low_speed_time)
+        retry = RetryPolicy().begin(request.resource['uri'] + request.format_param_str(), retries)
+        decoder = None
+        while True:
+            ## Dated and signed anew for each attempt, see send_request()
+            method_string, resource, headers = request.get_triplet()
+            progress = None
+            if show_progress:
+                progress = self.config.progress_class(labels, 0)
             else:
+                info("Receiving file '%s', please wait..." % stream.name)
+            timestamp_start = time.time()
+            try:
+                conn = self.get_connection(resource['bucket'])
+                conn.connect()
+                monitor.start(conn)
+                conn.putrequest(method_string, self.format_uri(resource))
+                for header in headers.keys():
+                    conn.putheader(header, str(headers[header]))
+                if start_position > 0 and end_position == -1:
+                    debug("Requesting Range: %d .. end" % start_position)
+                    conn.putheader("Range", "bytes=%d-" % start_position)
+                elif end_position != -1:
+                    debug("Requesting Range: %d .. %d" % (start_position, end_position))
+                    conn.putheader("Range", "bytes=%d-%d" % (start_position, end_position))
+                conn.endheaders()
+                response = {}
+                http_response = conn.getresponse()
+                response["status"] = http_response.status
+                response["reason"] = http_response.reason
+                response["headers"] = convertTupleListToDict(http_response.getheaders())
+                debug("Response: %s" % response)
+                if response["status"] < 200 or response["status"] > 299:
+                    response['data'] = http_response.read()
+                    conn.close()
+            except Exception, e:
+                if show_progress:
+                    progress.done("failed")
+                if monitor.cancelled:
+                    raise S3TransferCancelled("Download cancelled: %s" % resource['uri'])
+                # Connection error -> same throttle value
+                if retry.again(e):
+                    continue
                 self.exit_status = self.error_codes["RETRIES_EXCEEDED"]
                 raise S3DownloadError("Download failed for: %s" % resource['uri'])
 
-        if response["status"] == 307:
-            ## RedirectPermanent
-            response['data'] = http_response.read()
-            redir_bucket = getTextFromXml(response['data'], ".//Bucket")
-            redir_hostname = getTextFromXml(response['data'], ".//Endpoint")
-            self.set_hostname(redir_bucket, redir_hostname)
-            warning("Redirected to: %s" % (redir_hostname))
-            return self.recv_file(request, stream, labels, start_position, retries, end_position)
-
-        if response["status"] < 200 or response["status"] > 299:
-            raise S3Error(response)
-
-        if start_position == 0 and end_position == -1:
-            # Only compute MD5 on the fly if we're downloading from beginning
-            # Otherwise we'd get a nonsense.
-            md5_hash = md5()
-        size_left = int(response["headers"]["content-length"])
-        size_total = start_position + size_left
-        current_position = start_position
-
-        if self.config.progress_meter:
-            progress.total_size = size_total
-            progress.initial_position = current_position
-            progress.current_position = current_position
+            if response["status"] == 307:
+                ## RedirectPermanent
+                redir_bucket = getTextFromXml(response['data'], ".//Bucket")
+                redir_hostname = getTextFromXml(response['data'], ".//Endpoint")
+                self.set_hostname(redir_bucket, redir_hostname)
+                warning("Redirected to: %s" % (redir_hostname))
+                continue
+
+            if response["status"] < 200 or response["status"] > 299:
+                if show_progress:
+                    progress.done("failed")
+                e = S3Error(response)
+                if retry.again(e):
+                    continue
+                raise e
 
-        try:
-            while (current_position < size_total):
-                this_chunk = size_left > self.config.recv_chunk and self.config.recv_chunk or size_left
-                data = http_response.read(this_chunk)
-                stream.write(data)
-                if start_position == 0 and end_position == -1:
-                    md5_hash.update(data)
-                current_position += len(data)
-                ## Call progress meter from here...
-                if self.config.progress_meter:
-                    progress.update(delta_position = len(data))
-            conn.close()
-        except Exception, e:
-            if self.config.progress_meter:
-                progress.done("failed")
-            if retries:
-                warning("Retrying failed request: %s (%s)" % (resource['uri'], e))
-                warning("Waiting %d sec..." % self._fail_wait(retries))
-                time.sleep(self._fail_wait(retries))
-                # Connection error -> same throttle value
-                if end_position != -1:
-                   return self.recv_file(request, stream, labels, current_position, retries - 1)
-                else:
-                   return self.recv_file(request, stream, labels, start_position, retries - 1, end_position)
-            else:
+            if not decoder and end_position == -1 and self.is_encoded(response["headers"]):
+                if start_position > 0:
+                    warning(u"Can't resume encoded file %s, downloading it again" % unicodise(stream.name))
+                    conn.close()
+                    stream.seek(0)
+                    stream.truncate()
+                    start_position = 0
+                    continue
+                decoder = self.response_decoder(response["headers"], stream)
+                if decoder:
+                    stream = decoder
+
+            md5_hash = None
+            if start_position == 0 and end_position == -1:
+                # Only compute MD5 on the fly if we're downloading from beginning
+                # Otherwise we'd get a nonsense.
+                md5_hash = md5()
+            size_left = int(response["headers"]["content-length"])
+            size_total = start_position + size_left
+            current_position = start_position
+
+            if show_progress:
+                progress.total_size = size_total
+                progress.initial_position = current_position
+                progress.current_position = current_position
+
+            limiter = BandwidthLimit().download()
+            pipeline = None
+            ## gpg writes the decrypted data from a thread of its own
+            dropper = None
+            if self.config.cache_neutral and not isinstance(decoder, GpgDecryptStream):
+                dropper = CacheDropper(stream, writing = True)
+            try:
+                if pipeline_available:
+                    write = stream.write
+                    if dropper:
+                        def write(data):
+                            stream.write(data)
+                            dropper.update()
+                    pipeline = Pipeline(response_reader(http_response), write, self.config.recv_chunk,
+                                        self.config.transfer_buffer_size, self.config.transfer_buffers, limiter, monitor)
+                    current_position += pipeline.run(size_left, md5_hash, progress)
+                    if current_position < size_total:
+                        raise IOError("Connection closed after %d of %d bytes" % (current_position, size_total))
+                while (current_position < size_total):
+                    this_chunk = size_left > self.config.recv_chunk and self.config.recv_chunk or size_left
+                    data = http_response.read(this_chunk)
+                    if not data:
+                        raise IOError("Connection closed after %d of %d bytes" % (current_position, size_total))
+                    limiter.consume(len(data))
+                    stream.write(data)
+                    if dropper:
+                        dropper.update()
+                    if md5_hash:
+                        md5_hash.update(data)
+                    current_position += len(data)
+                    monitor.update(len(data))
+                    ## Call progress meter from here...
+                    if show_progress:
+                        progress.update(delta_position = len(data))
+                conn.close()
+                if dropper:
+                    dropper.finish()
+            except Exception, e:
+                if show_progress:
+                    progress.done("failed")
+                if dropper:
+                    dropper.finish()
+                if monitor.cancelled:
+                    raise S3TransferCancelled("Download cancelled: %s" % resource['uri'])
+                if isinstance(e, S3DecodeError):
+                    raise S3DownloadError(u"Decoding failed: %s" % e)
+                if pipeline:
+                    current_position = start_position + pipeline.transferred
+                if retry.again(e):
+                    # Continue from where we stopped, the stream
+                    # is already positioned right after the received data
+                    start_position = current_position
+                    continue
                 self.exit_status = self.error_codes["RETRIES_EXCEEDED"]
                 raise S3DownloadError("Download failed for: %s" % resource['uri'])
 
+            retry.done()
+            break
+
         stream.flush()
+        if decoder:
+            try:
+                decoder.finish()
+            except IOError, e:
+                raise S3DownloadError(u"Decoding failed: %s" % e)
         timestamp_end = time.time()
 
-        if self.config.progress_meter:
+        if show_progress:
             ## The above stream.flush() may take some time -> update() progress meter
             ## to correct the average speed. Otherwise people will complain that
             ## 'progress' and response["speed"] are inconsistent ;-)
@@ -1100,7 +2270,12 @@ class S3(object):
             progress.done("done")
 
         if end_position == -1:
-            if start_position == 0:
+            if decoder and response["headers"].has_key("x-amz-meta-s3cmd-md5"):
+                # Verify the decoded data against the original file
+                response["md5"] = decoder.md5_hash.hexdigest()
+            elif decoder:
+                response["md5"] = decoder.raw_md5_hash.hexdigest()
+            elif start_position == 0:
                 # Only compute MD5 on the fly if we were downloading from the beginning
                 response["md5"] = md5_hash.hexdigest()
             else:
@@ -1114,7 +2289,9 @@ class S3(object):
                     response["md5"] = response["headers"]["etag"]
 
             file_md5sum = response["headers"]["etag"].strip('"\'')
-            if len(response["headers"]["etag"].split('-')) == 2:
+            if decoder and response["headers"].has_key("x-amz-meta-s3cmd-md5"):
+                file_md5sum = response["headers"]["x-amz-meta-s3cmd-md5"]
+            elif len(response["headers"]["etag"].split('-')) == 2:
                 try:
                     file_md5sum = response['headers']['x-amz-meta-md5sum']
                 except:
@@ -1134,7 +2311,25 @@ class S3(object):
             warning("Reported size (%s) does not match received size (%s)" % (
                 start_position + response["headers"]["content-length"], response["size"]))
             self.exit_status = self.error_codes["SIZE_MISMATCH"]
+        if decoder:
+            response["size"] = decoder.size
         return response
+
+    def is_encoded(self, headers):
+        return headers.has_key("x-amz-meta-s3cmd-compress") or headers.has_key("x-amz-meta-s3tools-gpgenc")
+
+    def response_decoder(self, headers, stream):
+        """
+        Returns a wrapper of 'stream' that decrypts or decompresses
+        objects stored that way by s3cmd, or None if it can't.
+        """
+        if headers.has_key("x-amz-meta-s3tools-gpgenc"):
+            return GpgDecryptStream(stream)
+        try:
+            return DecompressingStream(stream, get_codec(headers["x-amz-meta-s3cmd-compress"]))
+        except ParameterError, e:
+            warning(u"%s, saving %s as it is" % (e, stream.name))
+        return None
 __all__.append("S3")
 
 # vim:et:ts=4:sts=4:ai
@@ -13,6 +13,11 @@ import rfc822
 import hmac
 import base64
 import errno
+import select
+import socket
+import mmap
+import shutil
+import tempfile
 
 from logging import debug, info, warning, error
 
@@ -26,6 +31,24 @@ if sys.version_info[0] == 2 and sys.version_info[1] < 6:
 else:
     from hashlib import md5, sha1
 
+try:
+    import io
+except ImportError:
+    ## Python < 2.6, no O_DIRECT reads
+    io = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import ctypes
+    _libc = ctypes.CDLL(None, use_errno = True)
+except Exception:
+    ## No ctypes (Python 2.4) or no shared libc
+    _libc = None
+
 try:
     import xml.etree.ElementTree as ET
 except ImportError:
@@ -162,6 +185,20 @@ def formatSize(size, human_readable = False, floating_point = False):
         return (size, "")
 __all__.append("formatSize")
 
+def parse_size(size):
+    """
+    Convert a size like "512", "100k", "2M" or "1G" to bytes.
+    Raises ValueError for anything else.
+    """
+    size = str(size).strip()
+    coeffs = { 'k' : 1024, 'm' : 1024 ** 2, 'g' : 1024 ** 3 }
+    coeff = 1
+    if size[-1:].lower() in coeffs:
+        coeff = coeffs[size[-1].lower()]
+        size = size[:-1]
+    return int(float(size) * coeff)
+__all__.append("parse_size")
+
 def formatDateTime(s3timestamp):
     return time.strftime("%Y-%m-%d %H:%M", dateS3toPython(s3timestamp))
 __all__.append("formatDateTime")
@@ -212,17 +249,270 @@ __all__.append("mktmpfile")
 
 def hash_file_md5(filename):
     h = md5()
-    f = open(filename, "rb")
+    f = open_bulk(filename)
+    dropper = None
+    if Config.Config().cache_neutral:
+        dropper = CacheDropper(f, 0)
     while True:
         # Hash 32kB chunks
         data = f.read(32*1024)
         if not data:
             break
         h.update(data)
+        if dropper:
+            dropper.update()
+    if dropper:
+        dropper.finish()
     f.close()
     return h.hexdigest()
 __all__.append("hash_file_md5")
 
+def hash_file_md5_prefix(filename, length):
+    """
+    Returns the MD5 of the first 'length' bytes of 'filename' and the
+    MD5 of the whole file, from a single read of it.
+    """
+    h = md5()
+    prefix_md5 = None
+    position = 0
+    f = open_bulk(filename)
+    try:
+        while True:
+            if position == length:
+                prefix_md5 = h.hexdigest()
+            chunk = 32*1024
+            if position < length:
+                chunk = min(chunk, length - position)
+            data = f.read(chunk)
+            if not data:
+                break
+            h.update(data)
+            position += len(data)
+    finally:
+        f.close()
+    return prefix_md5, h.hexdigest()
+__all__.append("hash_file_md5_prefix")
+
+if hasattr(os, "sendfile"):
+    _sendfile = os.sendfile
+elif _libc and sys.platform.startswith("linux") and hasattr(_libc, "sendfile64"):
+    _libc.sendfile64.argtypes = [ ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t ]
+    _libc.sendfile64.restype = getattr(ctypes, "c_ssize_t", ctypes.c_long)
+    def _sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = _libc.sendfile64(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+else:
+    _sendfile = None
+
+def sendfile(sock, file, offset, count):
+    """
+    sendfile(sock, file, offset, count)
+
+    Send up to 'count' bytes of 'file' starting at 'offset' to socket
+    'sock' without copying them through user space. Waits for the
+    socket to become writable if it's in non-blocking (timeout) mode.
+
+    Returns the number of bytes sent. Raises OSError with errno
+    ENOSYS if the platform doesn't support sendfile().
+    """
+    if not _sendfile:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    while True:
+        try:
+            return _sendfile(sock.fileno(), file.fileno(), offset, count)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.EAGAIN:
+                raise
+        if not select.select([], [sock], [], sock.gettimeout())[1]:
+            raise socket.timeout("timed out")
+__all__.append("sendfile")
+
+## Linux values, other platforms get posix_fadvise() from os only
+POSIX_FADV_SEQUENTIAL = getattr(os, "POSIX_FADV_SEQUENTIAL", 2)
+POSIX_FADV_WILLNEED = getattr(os, "POSIX_FADV_WILLNEED", 3)
+POSIX_FADV_DONTNEED = getattr(os, "POSIX_FADV_DONTNEED", 4)
+
+if hasattr(os, "posix_fadvise"):
+    _fadvise = os.posix_fadvise
+elif _libc and sys.platform.startswith("linux") and hasattr(_libc, "posix_fadvise64"):
+    _libc.posix_fadvise64.argtypes = [ ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int ]
+    def _fadvise(fd, offset, length, advice):
+        ## Returns the error number instead of setting errno
+        err = _libc.posix_fadvise64(fd, offset, length, advice)
+        if err:
+            raise OSError(err, os.strerror(err))
+else:
+    _fadvise = None
+
+if _libc and sys.platform.startswith("linux") and hasattr(_libc, "sync_file_range"):
+    _libc.sync_file_range.argtypes = [ ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint ]
+    def _sync_range(fd, offset, length):
+        ## SYNC_FILE_RANGE_WAIT_BEFORE | _WRITE | _WAIT_AFTER
+        if _libc.sync_file_range(fd, offset, length, 7) < 0:
+            os.fdatasync(fd)
+else:
+    def _sync_range(fd, offset, length):
+        os.fdatasync(fd)
+
+def fadvise(fd, offset, length, advice):
+    """
+    posix_fadvise() where available. Returns False if the
+    platform or the file (e.g. a pipe) doesn't support it.
+    """
+    if not _fadvise:
+        return False
+    try:
+        _fadvise(fd, offset, length, advice)
+    except OSError, e:
+        debug("posix_fadvise(%d) failed: %s" % (advice, e))
+        return False
+    return True
+__all__.append("fadvise")
+
+class CacheDropper(object):
+    """
+    CacheDropper(file, start = None, writing = False, step = 8 MB)
+
+    Keeps a bulk transfer from pushing everything else out of the page
+    cache: advises the kernel that 'file' is accessed sequentially and
+    drops the data from 'start' (default: the current position) on out
+    of the cache once the transfer
+    is past them, 'step' bytes at a time. Call update() after reading
+    or writing, with the position if file.tell() doesn't tell it, and
+    finish() at the end. Written data are flushed to disk before being
+    dropped, dirty pages would stay. Does nothing for files without a
+    descriptor or where posix_fadvise() is missing.
+    """
+    def __init__(self, file, start = None, writing = False, step = 8 * 1024 * 1024):
+        self.file = file
+        self.start = start
+        self.writing = writing
+        self.step = step
+        try:
+            self.fd = file.fileno()
+        except (AttributeError, ValueError, IOError):
+            self.fd = None
+        if self.fd is not None and not fadvise(self.fd, 0, 0, POSIX_FADV_SEQUENTIAL):
+            self.fd = None
+        if self.fd is not None and start is None:
+            self.start = file.tell()
+
+    def update(self, position = None):
+        if self.fd is None:
+            return
+        if position is None:
+            position = self.file.tell()
+        if position - self.start >= self.step:
+            self._drop(position)
+
+    def finish(self, position = None):
+        if self.fd is None:
+            return
+        if position is None:
+            position = self.file.tell()
+        if position > self.start:
+            self._drop(position)
+
+    def _drop(self, position):
+        try:
+            if self.writing:
+                self.file.flush()
+                _sync_range(self.fd, self.start, position - self.start)
+            fadvise(self.fd, self.start, position - self.start, POSIX_FADV_DONTNEED)
+        except (IOError, OSError), e:
+            debug("Dropping %s from the page cache failed: %s" % (self.file.name, e))
+        self.start = position
+__all__.append("CacheDropper")
+
+class DirectFile(object):
+    """
+    DirectFile(filename, buffer_size = 1 MB)
+
+    Read-only file opened with O_DIRECT, read through a page aligned
+    buffer of 'buffer_size' bytes, so that its data never enter the
+    page cache. Any position can be seeked to, the reads are aligned
+    to whole blocks behind the scenes. Use open_bulk() to get one.
+    """
+    block_size = 4096
+
+    def __init__(self, filename, buffer_size = 1024 * 1024):
+        fd = os.open(filename, os.O_RDONLY | os.O_DIRECT)
+        self.file = io.FileIO(fd, "r")
+        self.buffer = mmap.mmap(-1, buffer_size)
+        self.name = filename
+        self.position = 0
+        self.buffer_start = 0
+        self.buffer_length = 0
+        ## Fails here with EINVAL on filesystems without O_DIRECT
+        try:
+            self._fill(0)
+        except:
+            self.close()
+            raise
+
+    def _fill(self, position):
+        self.buffer_start = position - position % self.block_size
+        self.file.seek(self.buffer_start)
+        self.buffer_length = self.file.readinto(self.buffer) or 0
+
+    def seek(self, offset, whence = 0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += os.fstat(self.file.fileno()).st_size
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size = -1):
+        chunks = []
+        while size != 0:
+            offset = self.position - self.buffer_start
+            if offset < 0 or offset >= self.buffer_length:
+                self._fill(self.position)
+                offset = self.position - self.buffer_start
+            available = max(0, self.buffer_length - offset)
+            if available == 0:
+                break
+            if size > 0:
+                available = min(size, available)
+                size -= available
+            chunks.append(self.buffer[offset:offset + available])
+            self.position += available
+        return "".join(chunks)
+
+    def readinto(self, target):
+        data = self.read(len(target))
+        target[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.file.close()
+        self.buffer.close()
+__all__.append("DirectFile")
+
+def open_bulk(filename):
+    """
+    Open 'filename' for reading it all in one go, with O_DIRECT if
+    Config.direct_io is set and the filesystem can do it.
+    """
+    if Config.Config().direct_io and io and hasattr(os, "O_DIRECT"):
+        try:
+            return DirectFile(filename)
+        except (IOError, OSError), e:
+            if e.errno != errno.EINVAL:
+                raise
+            debug(u"%s: no O_DIRECT here, reading it the usual way" % unicodise(filename))
+    return open(filename, "rb")
+__all__.append("open_bulk")
+
 def concat_files(dest_handle, unlink = True, *source_handles):
     """
     Read data from source file handles and write the data into dest_handle
@@ -246,6 +536,61 @@ def concat_files(dest_handle, unlink = True, *source_handles):
     return h.hexdigest(), dest_handle.tell()
 __all__.append("concat_files")
 
+## _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+def _reflink(src_file, dst_file):
+    if not fcntl or not sys.platform.startswith("linux"):
+        return False
+    try:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except (IOError, OSError), e:
+        debug("FICLONE failed: %s" % e)
+        return False
+    return True
+
+def copy_local_file(src, dst, hardlink = False):
+    """
+    Replace 'dst' by a copy of local file 'src': a hard link with
+    'hardlink', otherwise a reflink sharing the data on filesystems
+    that can (btrfs, XFS, ...) and a plain copy elsewhere. The copy
+    is made under a temporary name and renamed over 'dst'.
+    Returns "hardlink", "reflink" or "copy".
+    """
+    fd, tmp_name = tempfile.mkstemp(prefix = ".s3cmd-", dir = os.path.dirname(dst) or ".")
+    try:
+        if hardlink:
+            os.close(fd)
+            os.unlink(tmp_name)
+            os.link(src, tmp_name)
+            how = "hardlink"
+        else:
+            dst_file = os.fdopen(fd, "wb")
+            try:
+                src_file = open(src, "rb")
+                try:
+                    how = "reflink"
+                    if not _reflink(src_file, dst_file):
+                        how = "copy"
+                        shutil.copyfileobj(src_file, dst_file, 1024 * 1024)
+                finally:
+                    src_file.close()
+            finally:
+                dst_file.close()
+            ## Permissions like those of a downloaded file, mkstemp() uses 0600
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_name, 0666 & ~umask)
+        os.rename(tmp_name, dst)
+    except:
+        try:
+            os.unlink(tmp_name)
+        except OSError:
+            pass
+        raise
+    return how
+__all__.append("copy_local_file")
+
 
 def mkdir_with_parents(dir_name):
     """
@@ -342,9 +687,11 @@ def replace_nonprintables(string):
     return new_string
 __all__.append("replace_nonprintables")
 
-def sign_string(string_to_sign):
+def sign_string(string_to_sign, secret_key = None):
     #debug("string_to_sign: %s" % string_to_sign)
-    signature = base64.encodestring(hmac.new(Config.Config().secret_key, string_to_sign, sha1).digest()).strip()
+    if secret_key is None:
+        secret_key = Config.Config().secret_key
+    signature = base64.encodestring(hmac.new(secret_key, string_to_sign, sha1).digest()).strip()
     #debug("signature: %s" % signature)
     return signature
 __all__.append("sign_string")
@@ -402,8 +749,10 @@ def getBucketFromHostname(hostname):
     return m.groups()[0], True
 __all__.append("getBucketFromHostname")
 
-def getHostnameFromBucket(bucket):
-    return Config.Config().host_bucket % { 'bucket' : bucket }
+def getHostnameFromBucket(bucket, host_bucket = None):
+    if host_bucket is None:
+        host_bucket = Config.Config().host_bucket
+    return host_bucket % { 'bucket' : bucket }
 __all__.append("getHostnameFromBucket")
 
 # vim:et:ts=4:sts=4:ai
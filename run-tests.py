@@ -12,6 +12,10 @@ import re
 from subprocess import Popen, PIPE, STDOUT
 import locale
 import pwd
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
 count_pass = 0
 count_fail = 0
@@ -443,6 +447,16 @@ test_mkdir("Make dst dir for get", "testsuite-out")
 test_s3cmd("Get multiple files", ['get', '%s/xyz/etc2/Logo.PNG' % pbucket(1), '%s/xyz/etc/AtomicClockRadio.ttf' % pbucket(1), 'testsuite-out'],
     must_find = [ u"saved as 'testsuite-out/Logo.PNG'", u"saved as 'testsuite-out/AtomicClockRadio.ttf'" ])
 
+## ====== Put from stdin, more than one multipart upload part (16MB by default)
+stdin_data = os.urandom(17 * 1024 * 1024)
+open("testsuite-out/stdin.bin", "wb").write(stdin_data)
+test("Put from stdin", ['sh', '-c', 'python s3cmd put - %s/xyz/stdin.bin < testsuite-out/stdin.bin' % pbucket(1)],
+    must_find = [ "Stdin stored as '%s/xyz/stdin.bin'" % pbucket(1) ])
+
+## ====== Verify MD5 of stdin upload
+test_s3cmd("Verify stdin MD5", ['info', '%s/xyz/stdin.bin' % pbucket(1)],
+    must_find = [ "MD5 sum:   %s" % md5(stdin_data).hexdigest() ])
+
 ## ====== Upload files differing in capitalisation
 test_s3cmd("blah.txt / Blah.txt", ['put', '-r', 'testsuite/blahBlah', pbucket(1)],
     must_find = [ '%s/blahBlah/Blah.txt' % pbucket(1), '%s/blahBlah/blah.txt' % pbucket(1)])